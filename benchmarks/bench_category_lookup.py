@@ -0,0 +1,68 @@
+"""
+Micro-benchmark of the annotation conversion loop in CocoGenerator, which looks up a category for every annotation
+and a keypoint for each of its keypoints, plus the keypoint's Labelbox label as the ontology conversion does. The
+module-level lookup tables are timed against rebuilding the categories and keypoint member lists on every lookup
+and comparing against each keypoint for its label (as get_coco_category, Keypoint(...) and
+coco_category_to_labelbox used to).
+
+    python benchmarks/bench_category_lookup.py [--annotations 20000]
+"""
+import argparse
+import time
+
+from groundtruth_utils.coco.models.annotation import KeypointAnnotation
+from groundtruth_utils.coco.models.category import KEYPOINT_LABELS, KeypointCategory, all_coco_categories, \
+    get_coco_category
+
+# Labels of the 17 COCO keypoints, as a Labelbox ontology names them ('Left Eye')
+COCO_17_LABELS = [KEYPOINT_LABELS[keypoint] for keypoint in list(KeypointCategory.Keypoint)[:17]]
+
+
+def rebuilt_category(name):
+    categories = [category for category in all_coco_categories() if category.name.lower() == name.lower()]
+    return categories[0] if len(categories) > 0 else None
+
+
+def rebuilt_keypoint(value):
+    members = KeypointCategory.Keypoint.__members__
+    if isinstance(value, str):
+        key = value.replace(' ', '_').upper()
+        return members[key] if key in members else None
+    return list(members.values())[value - 1]
+
+
+def rebuilt_label(keypoint):
+    for member in KeypointCategory.Keypoint:
+        if keypoint == member:
+            return member.name.replace('_', ' ').title()
+    return None
+
+
+def convert(num_annotations, category_lookup, keypoint_lookup, label_lookup):
+    start = time.perf_counter()
+    for image_id in range(num_annotations):
+        annotation = KeypointAnnotation(image_id=image_id, category_id=category_lookup('person').id)
+        annotation.bbox = [10, 20, 30, 40]
+        for idx, label in enumerate(COCO_17_LABELS):
+            keypoint = keypoint_lookup(label)
+            annotation.add_keypoint(keypoint, idx, idx, KeypointAnnotation.Visibility.VISIBILITY_LABELED_VISIBLE)
+            if label_lookup(keypoint) != label:
+                raise Exception("Keypoint label mismatch for '%s'" % label)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--annotations', type=int, default=20000)
+    args = parser.parse_args()
+
+    tables = convert(args.annotations, get_coco_category, KeypointCategory.Keypoint, KEYPOINT_LABELS.get)
+    rebuilt = convert(args.annotations, rebuilt_category, rebuilt_keypoint, rebuilt_label)
+
+    print("%d annotations with 17 keypoints each" % args.annotations)
+    print("%-30s %8.3f s" % ('lookup tables', tables))
+    print("%-30s %8.3f s" % ('rebuilt per lookup', rebuilt))
+
+
+if __name__ == '__main__':
+    main()
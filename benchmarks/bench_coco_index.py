@@ -0,0 +1,60 @@
+"""
+Scaling benchmark for Coco's annotations-by-image index against a linear scan of the annotations.
+
+    python benchmarks/bench_coco_index.py [--annotations-per-image 5]
+
+Times looking up every image's annotations, which is what Labelbox.generate_mal_ndjson does. The indexed lookup
+grows linearly with the dataset, the scan quadratically.
+"""
+import argparse
+import time
+
+from groundtruth_utils.coco.models.annotation import KeypointAnnotation
+from groundtruth_utils.coco.models.coco import Coco
+from groundtruth_utils.coco.models.image import Image
+
+
+def build_coco(num_images, annotations_per_image):
+    coco = Coco()
+    for image_id in range(num_images):
+        file_name = "image-%d.jpg" % image_id
+        coco.images.append(Image.construct(id=image_id, file_name=file_name, coco_url=file_name, width=1, height=1))
+        for idx in range(annotations_per_image):
+            coco.annotations.append(KeypointAnnotation.construct(
+                id=image_id * annotations_per_image + idx, image_id=image_id, category_id=1))
+    return coco
+
+
+def time_indexed(coco):
+    start = time.perf_counter()
+    for image in coco.images:
+        coco.get_annotations_for_image(image.id)
+    return time.perf_counter() - start
+
+
+def time_scan(coco):
+    start = time.perf_counter()
+    for image in coco.images:
+        [annotation for annotation in coco.annotations if annotation.image_id == image.id]
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--annotations-per-image', type=int, default=5)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 5000, 10000, 20000])
+    parser.add_argument('--max-scan-size', type=int, default=5000,
+                        help="skip the linear scan above this many images, it takes minutes at 20k images")
+    args = parser.parse_args()
+
+    print("%10s %12s %12s %12s" % ('images', 'annotations', 'indexed (s)', 'scan (s)'))
+    for num_images in args.sizes:
+        coco = build_coco(num_images, args.annotations_per_image)
+        indexed = time_indexed(coco)
+        scan = time_scan(coco) if num_images <= args.max_scan_size else None
+        print("%10d %12d %12.4f %12s" % (num_images, len(coco.annotations), indexed,
+                                         "%.4f" % scan if scan is not None else '-'))
+
+
+if __name__ == '__main__':
+    main()
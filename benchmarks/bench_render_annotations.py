@@ -0,0 +1,81 @@
+"""
+Benchmark draw.render_annotations on 4K frames against per-shape PIL ImageDraw drawing, the way draw_annotations
+rendered annotations before.
+
+    python benchmarks/bench_render_annotations.py [--people 30] [--frames 20]
+
+Each person has a bounding box and 17 COCO keypoints, render_annotations also draws their skeleton limbs.
+"""
+import argparse
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from groundtruth_utils.coco.models.category import KeypointCategory
+from groundtruth_utils.draw import render_annotations
+
+FRAME_WIDTH = 3840
+FRAME_HEIGHT = 2160
+
+
+def random_people(rng, num_people):
+    left = rng.uniform(0, FRAME_WIDTH - 400, num_people)
+    top = rng.uniform(0, FRAME_HEIGHT - 800, num_people)
+    width = rng.uniform(100, 400, num_people)
+    height = rng.uniform(300, 800, num_people)
+    boxes = np.stack([left, top, width, height], axis=1)
+
+    points = np.empty((num_people, 17, 3))
+    points[:, :, 0] = left[:, None] + rng.uniform(0, 1, (num_people, 17)) * width[:, None]
+    points[:, :, 1] = top[:, None] + rng.uniform(0, 1, (num_people, 17)) * height[:, None]
+    points[:, :, 2] = 2
+    return boxes, points
+
+
+def render_pil(frame, boxes, points):
+    image = Image.fromarray(frame)
+    draw = ImageDraw.Draw(image, 'RGBA')
+    for left, top, width, height in boxes:
+        draw.rectangle([(int(left), int(top)), (int(left) + int(width), int(top) + int(height))],
+                       fill=(0, 166, 156, 50), outline=(255, 255, 255), width=3)
+    for x, y, _ in points.reshape((-1, 3)):
+        draw.ellipse([(int(x) - 3, int(y) - 3), (int(x) + 3, int(y) + 3)],
+                     fill=(65, 255, 126, 95), outline=(65, 255, 126))
+    return np.asarray(image)
+
+
+def render_batched(frame, boxes, points, skeleton):
+    return render_annotations(frame, boxes=boxes, points=points, skeleton=skeleton)
+
+
+def time_frames(render, frames):
+    start = time.perf_counter()
+    for args in frames:
+        render(*args)
+    return (time.perf_counter() - start) / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--people', type=int, default=30)
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    frame = rng.integers(0, 256, (FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+    people = [random_people(rng, args.people) for _ in range(args.frames)]
+    skeleton = KeypointCategory.coco_17_person_skeleton()
+
+    pil = time_frames(render_pil, [(frame, boxes, points) for boxes, points in people])
+    batched = time_frames(render_batched, [(frame, boxes, points, skeleton) for boxes, points in people])
+
+    print("%dx%d frames, %d people (%d boxes, %d keypoints)" % (
+        FRAME_WIDTH, FRAME_HEIGHT, args.people, args.people, args.people * 17))
+    print("%-40s %8.1f ms/frame" % ('PIL ImageDraw, per shape (no skeleton)', pil * 1000))
+    print("%-40s %8.1f ms/frame" % ('render_annotations (with skeleton)', batched * 1000))
+
+
+if __name__ == '__main__':
+    main()
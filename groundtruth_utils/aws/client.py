@@ -0,0 +1,60 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+# Connections each client keeps open, boto3's default of 10 throttles the thread pools listing and fetching from S3
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('WF_GROUNDTRUTH_AWS_MAX_POOL_CONNECTIONS', 64))
+AWS_MAX_RETRIES = int(os.getenv('WF_GROUNDTRUTH_AWS_MAX_RETRIES', 4))
+
+DEFAULT_CLIENT_CONFIG = Config(
+    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    connect_timeout=10,
+    read_timeout=60,
+    retries={'mode': 'standard', 'max_attempts': AWS_MAX_RETRIES})
+
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _reset_clients():
+    global _session, _clients, _clients_lock
+    _session = None
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+
+# Pooled connections can't be shared with a forked child (nor can a lock another thread might hold), it starts
+# over with clients of its own
+os.register_at_fork(after_in_child=_reset_clients)
+
+
+def get_client(service_name, config=None):
+    """
+    boto3 client for service_name, created once and shared by every thread, so all threads draw on the one
+    connection pool of max_pool_connections. Clients are thread safe, the session they're created from isn't,
+    which is what the lock guards. Creating a client takes hundreds of milliseconds and every new client starts
+    with cold connections.
+
+    :param config: botocore Config merged over DEFAULT_CLIENT_CONFIG, clients are cached per config object so
+                   pass the same (e.g. module level) instance each time
+    :return: boto3 client
+    """
+    global _session
+
+    key = (service_name, config)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        if key not in _clients:
+            if _session is None:
+                _session = boto3.session.Session()
+
+            client_config = DEFAULT_CLIENT_CONFIG.merge(config) if config is not None else DEFAULT_CLIENT_CONFIG
+            _clients[key] = _session.client(service_name, config=client_config)
+
+        return _clients[key]
@@ -1,12 +1,24 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import io
 import os
 import re
 
-import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
+from .client import get_client
 from ..log import logger
 
+IMAGE_KEY_REGEX = re.compile(r".*\.(gif|jpe?g|tiff|png|webp|bmp)$", re.IGNORECASE)
+
+# Multipart uploads, S3 requires parts (other than the last) of at least 5MB and allows at most 10,000 of them
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MULTIPART_MAX_CONCURRENCY = 8
+UPLOAD_TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_PART_SIZE,
+                                        multipart_chunksize=MULTIPART_PART_SIZE,
+                                        max_concurrency=MULTIPART_MAX_CONCURRENCY)
+
 
 def download_fileobj_as_bytestream(s3_client, object_uri):
     bytes_stream = io.BytesIO()
@@ -15,6 +27,78 @@ def download_fileobj_as_bytestream(s3_client, object_uri):
     return bytes_stream
 
 
+def download_byte_range(s3_client, object_uri, start, end):
+    """Download bytes [start, end] (inclusive) of an S3 object, the result is shorter if the object is"""
+    bucket_name, key_name = split_s3_bucket_key(object_uri)
+    response = s3_client.get_object(Bucket=bucket_name, Key=key_name, Range="bytes=%d-%d" % (start, end))
+    return response['Body'].read()
+
+
+def _iter_lines(chunks):
+    """Split a stream of byte chunks into lines, without their line endings"""
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+
+    if len(pending) > 0:
+        yield pending
+
+
+def _iter_byte_ranges(s3_client, object_uri, size, range_size, max_workers):
+    """Download an object as concurrent ranged reads, yielding the ranges in order"""
+    ranges = iter(range(0, size, range_size))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_next():
+            for start in ranges:
+                pending.append(executor.submit(
+                    download_byte_range, s3_client, object_uri, start, min(start + range_size, size) - 1))
+                return
+
+        for _ in range(max_workers):
+            submit_next()
+
+        while len(pending) > 0:
+            data = pending.popleft().result()
+            submit_next()
+            yield data
+
+
+def iter_object_lines(s3_client, object_uri, chunk_size=1024 * 1024, max_workers=1, range_size=64 * 1024 * 1024):
+    """
+    Stream an S3 object's lines (e.g. a JSON lines manifest) without downloading it whole first
+
+    :param max_workers: when above 1, objects larger than range_size are downloaded as concurrent ranged reads,
+                        at most max_workers ranges are held in memory at once
+    :return: generator of lines as bytes, without their line endings
+    """
+    bucket_name, key_name = split_s3_bucket_key(object_uri)
+    if max_workers > 1:
+        size = s3_client.head_object(Bucket=bucket_name, Key=key_name)['ContentLength']
+        if size > range_size:
+            yield from _iter_lines(_iter_byte_ranges(s3_client, object_uri, size, range_size, max_workers))
+            return
+
+    body = s3_client.get_object(Bucket=bucket_name, Key=key_name)['Body']
+    try:
+        yield from _iter_lines(iter(lambda: body.read(chunk_size), b''))
+    finally:
+        body.close()
+
+
+def is_s3_uri(uri):
+    """True for s3:// URIs and virtual-hosted style https://$BUCKET.s3.amazonaws.com/ URLs"""
+    if uri.startswith('s3://'):
+        return True
+
+    if uri.startswith('https://'):
+        return uri[8:].split('/')[0].endswith('.s3.amazonaws.com')
+
+    return False
+
+
 #  Thanks https://stackoverflow.com/questions/4993439/how-can-i-access-s3-files-in-python-using-urls
 def find_bucket_key(s3_path):
     """
@@ -44,30 +128,71 @@ def split_s3_bucket_key(s3_path):
     return find_bucket_key(s3_path)
 
 
-def list_object_keys_in_folder(s3_client, folder_uri, filter_regex=None, image_filter=False):
+def _list_keys(s3_client, bucket_name, prefix, key_filter):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for key in page.get("Contents", []):
+            if key_filter is None or key_filter.match(key["Key"]):
+                yield key["Key"]
+
+
+def list_object_keys_in_folder(s3_client, folder_uri, filter_regex=None, image_filter=False, max_workers=16):
+    """
+    List the keys under an S3 folder, in lexicographic order like a plain listing would.
+
+    The folder's sub-prefixes are discovered with a '/' delimited listing and listed in parallel, keys are
+    yielded as soon as the listings before them are done.
+
+    :param filter_regex: only keys matching the pattern (case insensitive) are listed
+    :param image_filter: only list image keys, overrides filter_regex
+    :param max_workers: number of sub-prefixes listed concurrently
+    :return: generator of keys
+    """
     bucket_name, key_name = split_s3_bucket_key(folder_uri)
 
-    active_filter_regex = None
+    key_filter = None
     if image_filter:
-        active_filter_regex = r".*\.(gif|jpe?g|tiff|png|webp|bmp)$"
+        key_filter = IMAGE_KEY_REGEX
     elif filter_regex:
-        active_filter_regex = r"%s" % filter_regex
+        key_filter = re.compile(r"%s" % filter_regex, re.IGNORECASE)
+
+    # Keys directly in the folder and its sub-prefixes, descending while there's only a single sub-prefix
+    # (e.g. a folder URI without a trailing '/') to find prefixes to list in parallel
+    entries = [(key_name, True)]
+    paginator = s3_client.get_paginator('list_objects_v2')
+    while len(entries) == 1 and entries[0][1]:
+        prefix = entries[0][0]
+        entries = []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+            entries.extend((key["Key"], False) for key in page.get("Contents", []))
+            entries.extend((common_prefix["Prefix"], True) for common_prefix in page.get("CommonPrefixes", []))
+        entries.sort()
 
-    paginator = s3_client.get_paginator('list_objects')
-    iterator = paginator.paginate(Bucket=bucket_name, Prefix=key_name)
-    bucket_object_list = []
-    for page in iterator:
-        if "Contents" in page:
-            for key in page["Contents"]:
-                key_string = key["Key"]
+    max_workers = max(1, max_workers)
+    entries = iter(entries)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_next():
+            for name, is_prefix in entries:
+                if is_prefix:
+                    pending.append(executor.submit(list, _list_keys(s3_client, bucket_name, name, key_filter)))
+                    return
+                if key_filter is None or key_filter.match(name):
+                    pending.append(name)
 
-                match = True
-                if active_filter_regex is not None:
-                    match = bool(re.match(active_filter_regex, key_string, re.IGNORECASE))
-                if match:
-                    bucket_object_list.append(key_string)
+        # Sub-prefix listings are started ahead of the consumer, bounding the keys held in memory
+        for _ in range(max_workers * 2):
+            submit_next()
 
-    return bucket_object_list
+        while len(pending) > 0:
+            entry = pending.popleft()
+            if isinstance(entry, str):
+                yield entry
+                continue
+
+            keys = entry.result()
+            submit_next()
+            yield from keys
 
 
 def create_presigned_url(bucket_name, object_name, expiration=3600):
@@ -80,7 +205,7 @@ def create_presigned_url(bucket_name, object_name, expiration=3600):
     """
 
     # Generate a presigned URL for the S3 object
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     try:
         response = s3_client.generate_presigned_url('get_object',
                                                     Params={'Bucket': bucket_name,
@@ -98,11 +223,135 @@ def upload_file_to_bucket(file_path, bucket, object_name=None, meta_data={}):
     if object_name is None:
         object_name = os.path.basename(file_path)
 
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     try:
-        s3_client.upload_file(file_path, bucket, object_name, ExtraArgs={'Metadata': meta_data})
+        s3_client.upload_file(file_path, bucket, object_name, ExtraArgs={'Metadata': meta_data},
+                              Config=UPLOAD_TRANSFER_CONFIG)
     except ClientError as e:
         logger.error(e)
         return None
 
     return create_presigned_url(bucket, object_name)
+
+
+class S3MultipartWriter(object):
+    """
+    File-like writer streaming an S3 object as a multipart upload while its data is produced, so the object
+    never has to fit in memory or on local disk. Parts are uploaded concurrently as they fill up, with at most
+    max_concurrency parts (plus the one being filled) held in memory, writes block while they're all in flight.
+
+    Used as a context manager the upload is completed on exit, or aborted if the block raised.
+    """
+
+    def __init__(self, bucket, object_name, part_size=MULTIPART_PART_SIZE, max_concurrency=MULTIPART_MAX_CONCURRENCY,
+                 meta_data=None, s3_client=None):
+        if part_size < 5 * 1024 * 1024:
+            raise Exception("Multipart upload parts must be at least 5MB, got %d bytes" % part_size)
+
+        self.bucket = bucket
+        self.object_name = object_name
+        self.part_size = part_size
+        self.max_concurrency = max(1, max_concurrency)
+        self.meta_data = meta_data or {}
+        self.s3_client = s3_client or get_client('s3')
+
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._pending = deque()
+        self._executor = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _upload_part(self, part_number, data):
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.object_name, UploadId=self._upload_id,
+                                              PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def _finish_oldest_part(self):
+        self._parts.append(self._pending.popleft().result())
+
+    def _flush_part(self, data):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.object_name,
+                                                              Metadata=self.meta_data)
+            self._upload_id = response['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        while len(self._pending) >= self.max_concurrency:
+            self._finish_oldest_part()
+
+        part_number = len(self._parts) + len(self._pending) + 1
+        self._pending.append(self._executor.submit(self._upload_part, part_number, data))
+
+    def write(self, data):
+        if self._closed:
+            raise Exception("Write to closed S3 upload s3://%s/%s" % (self.bucket, self.object_name))
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._flush_part(part)
+
+        return len(data)
+
+    def close(self):
+        """Upload what's left and complete the upload"""
+        if self._closed:
+            return
+
+        try:
+            if self._upload_id is None:
+                # Everything fit in a single part, a plain PUT is cheaper than a multipart upload
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.object_name, Body=bytes(self._buffer),
+                                          Metadata=self.meta_data)
+            else:
+                if len(self._buffer) > 0:
+                    self._flush_part(bytes(self._buffer))
+                while len(self._pending) > 0:
+                    self._finish_oldest_part()
+
+                self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.object_name,
+                                                         UploadId=self._upload_id,
+                                                         MultipartUpload={'Parts': self._parts})
+        except Exception as e:
+            self.abort()
+            raise e
+
+        self._closed = True
+        self._buffer = bytearray()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def abort(self):
+        """Drop the upload, S3 discards the parts that were already uploaded"""
+        if self._closed:
+            return
+
+        self._closed = True
+        self._buffer = bytearray()
+        if self._executor is not None:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown()
+
+        if self._upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.object_name,
+                                                      UploadId=self._upload_id)
+            except ClientError as e:
+                logger.error("Failed aborting upload of s3://%s/%s: %s" % (self.bucket, self.object_name, e))
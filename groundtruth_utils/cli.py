@@ -7,9 +7,9 @@ import click_log
 from dotenv import load_dotenv
 
 from .annotate import Annotate
-from .draw import draw_annotations
+from .draw import draw_annotations, image_file_name, image_save_args, save_image
 from .log import logger
-from .core import create_dataset, create_job, delete_mals, fetch_annotations, fetch_jobs, generate_coco_dataset, generate_image_set, generate_mal_ndjson, generate_manifest, upload_coco_labels_to_job, upload_mal_ndjson, status_mal_ndjson
+from .core import convert_coco_dataset, create_dataset, create_job, delete_mals, fetch_annotations, fetch_jobs, generate_coco_dataset, generate_image_set, generate_mal_ndjson, generate_manifest, stream_mal_ndjson, upload_coco_labels_to_job, upload_mal_ndjson, status_mal_ndjson
 from .platforms.models.job import Job
 
 click_log.basic_config(logger)
@@ -27,6 +27,22 @@ def validate_json(ctx, param, value):
         raise click.BadParameter("{0} need to be in JSON format".format(param.name))
 
 
+def validate_image_size(ctx, param, value):
+    if value is None:
+        return
+
+    try:
+        size = tuple(int(dim) for dim in value.lower().split('x'))
+    except ValueError:
+        size = ()
+    if len(size) == 1:
+        size = (size[0], size[0])
+    if len(size) != 2 or min(size) < 1:
+        raise click.BadParameter("{0} needs to be WIDTHxHEIGHT or SIZE, e.g. 224x224".format(param.name))
+
+    return size
+
+
 @click.command(help="List groundtruth labeling jobs")
 @click.option("-p", "--platform", type=click.Choice(['sagemaker', 'labelbox'],
                                                     case_sensitive=False), default='labelbox', help="platform to fetch from")
@@ -66,8 +82,8 @@ def list_annotations(platform, no_consolidate, raw, job_name):
                                                     case_sensitive=False), default='labelbox', help="platform to fetch from")
 @click.option("-o", "--output", type=click.Path(), default="%s/output" % (os.getcwd()),
               help="output folder, exports stored in '$OUTPUT/$job_name/$timestamp'")
-@click.option("-m", "--mode", type=click.Choice(['combine', 'separate']), default='combine',
-              help="'combine' - produce a single image containing all image annotations, 'separate' - produce a single image per image annotation")
+@click.option("-m", "--mode", type=click.Choice(['combine', 'separate', 'crop', 'mosaic']), default='combine',
+              help="'combine' - produce a single image containing all image annotations, 'separate' - produce a single image per image annotation, 'crop' - produce a cropped image per bounding box annotation, 'mosaic' - produce contact sheets of downscaled annotated images for quick review")
 @click.option('--no-consolidate', is_flag=True, default=False,
               help="default action is to consolidate multiple data labeler's annotations, use this flag to disable consolidation")
 @click.option('--naked', is_flag=True, default=False,
@@ -77,9 +93,30 @@ def list_annotations(platform, no_consolidate, raw, job_name):
 @click.option('--filter-min-labelers', type=click.IntRange(0, 10), default=3,
               help="filter images labeled by a minimum number of labelers (0-10)")
 @click.option('--append', type=str, help="Job name for the job you want to append images to, use to filter out duplicates")
+@click.option('-w', '--workers', type=click.IntRange(1, 128), default=8,
+              help="number of images to download, and outputs to render, concurrently")
+@click.option('--max-pending', type=click.IntRange(1, 1024), default=None,
+              help="maximum number of downloaded images waiting to be drawn, defaults to twice the number of workers")
+@click.option('-f', '--format', 'image_format', type=click.Choice(['png', 'jpeg', 'webp']), default='png',
+              help="output image format, files get the format's extension")
+@click.option('--quality', type=click.IntRange(1, 100), default=None, help="JPEG/WebP quality (1-100)")
+@click.option('--compress-level', type=click.IntRange(0, 9), default=None,
+              help="PNG compression level (0-9), lower levels encode faster but produce larger files")
+@click.option('--encode-workers', type=click.IntRange(0, 128), default=None,
+              help="number of processes encoding images, defaults to the number of CPUs, 0 encodes in-process")
+@click.option('--crop-padding', type=click.FloatRange(0.0, 10.0), default=0.1,
+              help="'crop' mode, margin added around each bounding box as a fraction of its size")
+@click.option('--crop-size', type=str, default=None, callback=validate_image_size,
+              help="'crop' mode, resize crops to WIDTHxHEIGHT (or SIZE for square crops), crops are expanded to the size's aspect ratio")
+@click.option('--mosaic-grid', type=str, default='8x8', callback=validate_image_size,
+              help="'mosaic' mode, COLUMNSxROWS of images on each contact sheet")
+@click.option('--mosaic-tile-size', type=str, default='320x200', callback=validate_image_size,
+              help="'mosaic' mode, WIDTHxHEIGHT of each image's tile on a contact sheet, including its label")
 @click.argument("job_name")
 def cli_generate_image_set(platform, output, mode, no_consolidate, naked,
-                           filter_min_confidence, filter_min_labelers, append, job_name):
+                           filter_min_confidence, filter_min_labelers, append, workers, max_pending,
+                           image_format, quality, compress_level, encode_workers, crop_padding, crop_size,
+                           mosaic_grid, mosaic_tile_size, job_name):
     consolidate = not no_consolidate
     generate_image_set(
         job_name,
@@ -90,7 +127,17 @@ def cli_generate_image_set(platform, output, mode, no_consolidate, naked,
         naked=naked,
         filter_min_confidence=filter_min_confidence,
         filter_min_labelers=filter_min_labelers,
-        append_job_name=append)
+        append_job_name=append,
+        max_workers=workers,
+        max_pending=max_pending,
+        image_format=image_format,
+        quality=quality,
+        compress_level=compress_level,
+        encode_workers=encode_workers,
+        crop_padding=crop_padding,
+        crop_size=crop_size,
+        mosaic_grid=mosaic_grid,
+        mosaic_tile_size=mosaic_tile_size)
 
 
 @click.command(name="generate-manifest", help="Generate a job/dataset manifest file from an AWS folder")
@@ -116,14 +163,36 @@ def cli_generate_manifest(platform, metadata, s3_images_uri):
               help="filter images labeled by a minimum number of labelers (0-10)")
 @click.option('--validation-set', type=click.FloatRange(0.0, .35), default=0.0,
               help="creates a validation coco set using the given percentage")
+@click.option('--validation-seed', type=int, default=None,
+              help="seed for the validation split, use to make splits reproducible")
+@click.option('--validation-stratify', is_flag=True, default=False,
+              help="balance category and keypoint visibility counts across the training and validation sets")
+@click.option('--validation-group-pattern', type=str, default=None,
+              help="regex applied to image file names, images sharing the first capture group (e.g. classroom or camera) stay in the same set")
 @click.option('--coco-file-name', type=str, default="coco-{}.json".format(now),
               help="output file name, defaults to coco-$timestamp.json")
 @click.option('--validation-file-name', type=str, default="coco-val-{}.json".format(now),
               help="output file name, defaults to coco-val-$timestamp.json")
+@click.option('-w', '--workers', type=click.IntRange(1, 32), default=4,
+              help="number of jobs to fetch from the platform concurrently")
+@click.option('--gzip', 'gzip_output', is_flag=True, default=False,
+              help="gzip the coco output files, '.gz' is appended to file names")
+@click.option('--probe-dimensions', is_flag=True, default=False,
+              help="fill in image width/height by fetching only each image's header bytes, results are cached")
+@click.option('--probe-workers', type=click.IntRange(1, 128), default=16,
+              help="number of images to probe concurrently")
+@click.option('--shards', type=click.IntRange(1, 512), default=1,
+              help="split the (training) coco output into N (at most 512) shard files balanced by annotation "
+                   "count, plus a $COCO_FILE_NAME.shards.json index")
+@click.option('--incremental-manifest', type=click.Path(), default=None,
+              help="manifest of per-image input hashes (created if missing), only images whose labels or job config "
+                   "changed since the last run are regenerated and image/annotation ids stay stable")
 @click.argument("coco_generate_config", type=click.File('rb'))
 def cli_generate_coco(platform, output, mode, filter_min_confidence,
                       filter_min_labelers, coco_generate_config, validation_set,
-                      coco_file_name, validation_file_name):
+                      coco_file_name, validation_file_name, workers, gzip_output,
+                      validation_seed, validation_stratify, validation_group_pattern, probe_dimensions,
+                      probe_workers, shards, incremental_manifest):
     separate = mode == 'separate'
     generate_coco_dataset(coco_generate_config,
                           output=output,
@@ -133,7 +202,24 @@ def cli_generate_coco(platform, output, mode, filter_min_confidence,
                           filter_min_labelers=filter_min_labelers,
                           validation_set=validation_set,
                           coco_file_name=coco_file_name,
-                          validation_file_name=validation_file_name)
+                          validation_file_name=validation_file_name,
+                          max_workers=workers,
+                          gzip_output=gzip_output,
+                          validation_seed=validation_seed,
+                          validation_stratify=validation_stratify,
+                          validation_group_pattern=validation_group_pattern,
+                          probe_dimensions=probe_dimensions,
+                          probe_workers=probe_workers,
+                          shards=shards,
+                          incremental_manifest=incremental_manifest)
+
+
+@click.command(name="convert-coco",
+               help="Convert a coco dataset between JSON (.json/.json.gz) and the binary columnar format (.npz)")
+@click.argument("input_file", type=click.Path(exists=True))
+@click.argument("output_file", type=click.Path())
+def cli_convert_coco(input_file, output_file):
+    convert_coco_dataset(input_file, output_file)
 
 
 @click.command(name="create-dataset", help="Generate a Labelbox dataset using a manifest file")
@@ -156,7 +242,8 @@ def cli_create_job(platform, ontology, dataset_id, job_name):
 
 
 @click.command(name="upload-coco-labels-to-job", help="Load coco labels into a Labelbox dataset")
-@click.option("-c", "--coco-json", type=click.Path(exists=True), required=True, help="Coco formatted JSON data")
+@click.option("-c", "--coco-json", type=click.Path(exists=True), required=True,
+              help="Coco formatted JSON data, or a binary .npz dataset (see convert-coco)")
 @click.argument("job_name")
 def cli_upload_coco_labels_to_job(coco_json, job_name):
     upload_coco_labels_to_job(job_name, coco_json)
@@ -164,15 +251,24 @@ def cli_upload_coco_labels_to_job(coco_json, job_name):
 
 @click.command(name="generate-mal-ndjson", help="Generate a model assisted labeling ndJSON file for Labelbox")
 @click.option("-c", "--coco-json", type=click.Path(exists=True),
-              help="Coco formatted JSON data. Will use coco data rather than Yolo + Alphapose to generate ndJSON data.")
+              help="Coco formatted JSON data, or a binary .npz dataset (see convert-coco). "
+                   "Will use coco data rather than Yolo + Alphapose to generate ndJSON data.")
 @click.option("-o", "--output", type=click.Path(), default="%s/output" % (os.getcwd()),
               help="output folder, exports stored in '$OUTPUT/labelmaker-mal-$timestamp.ndjson'")
 @click.option('--upload', is_flag=True, default=False, help="Upload the ndJSON file after it's generated")
+@click.option('--stream', is_flag=True, default=False,
+              help="Upload ndJSON records to S3 as they're generated, without writing a local file (implies --upload)")
 @click.option('-d', '--dataset-id', type=str,
               help="general ndjson records for a specific dataset in the job")
 @click.argument("job_name")
 @click.pass_context
-def cli_generate_mal_ndjson(ctx, output, job_name, upload, coco_json=None, dataset_id=None):
+def cli_generate_mal_ndjson(ctx, output, job_name, upload, stream, coco_json=None, dataset_id=None):
+    if stream:
+        import_id = stream_mal_ndjson(job_name, coco_json, dataset_id)
+        if import_id is not None:
+            click.echo("Started MAL import job: %s" % (import_id))
+        return
+
     file_name = generate_mal_ndjson(job_name, output, coco_json, dataset_id)
 
     if upload and file_name:
@@ -210,7 +306,12 @@ def cli_delete_mals(mal_files, output, job_name):
 
 @click.command(name="annotate-image", help="Annotate an image")
 @click.option("-i", "--image", type=click.Path(exists=True), required=True, help="Image to annotate")
-def cli_annotate_image(image):
+@click.option('-f', '--format', 'image_format', type=click.Choice(['png', 'jpeg', 'webp']), default='png',
+              help="output image format, files get the format's extension")
+@click.option('--quality', type=click.IntRange(1, 100), default=None, help="JPEG/WebP quality (1-100)")
+@click.option('--compress-level', type=click.IntRange(0, 9), default=None,
+              help="PNG compression level (0-9), lower levels encode faster but produce larger files")
+def cli_annotate_image(image, image_format, quality, compress_level):
     annotator = Annotate()
     annotations = annotator.annotate_image(image)
 
@@ -218,8 +319,9 @@ def cli_annotate_image(image):
         from PIL import Image
         annotated_image = draw_annotations(Image.open(image), annotations)
 
-        annotated_image_path = os.path.join(os.path.dirname(image), 'output.png')
-        annotated_image.save(annotated_image_path)
+        annotated_image_path = os.path.join(os.path.dirname(image), image_file_name('output', image_format))
+        save_image(annotated_image, annotated_image_path,
+                   image_save_args(image_format, quality=quality, compress_level=compress_level))
         logger.info("Saved annotated image to: {}".format(annotated_image_path))
         click.echo(json.dumps(annotations, indent=4))
     else:
@@ -244,6 +346,7 @@ cli.add_command(list_annotations)
 cli.add_command(cli_generate_image_set)
 cli.add_command(cli_generate_manifest)
 cli.add_command(cli_generate_coco)
+cli.add_command(cli_convert_coco)
 cli.add_command(cli_create_job)
 cli.add_command(cli_create_dataset)
 cli.add_command(cli_upload_coco_labels_to_job)
@@ -0,0 +1,167 @@
+import json
+import struct
+import zipfile
+
+import numpy as np
+
+from .models.annotation import KeypointAnnotation
+from .models.category import BaseCategory, KeypointCategory
+from .models.image import Image
+
+COCO_NPZ_FORMAT_VERSION = 1
+
+
+def is_coco_npz(file_path):
+    return str(file_path).endswith('.npz')
+
+
+def _pack_strings(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if len(encoded) > 0:
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(blob, offsets):
+    data = np.asarray(blob).tobytes()
+    offsets = np.asarray(offsets).tolist()
+    return [data[offsets[idx]:offsets[idx + 1]].decode('utf-8') for idx in range(len(offsets) - 1)]
+
+
+def coco_to_arrays(coco):
+    """
+    Convert a Coco model to columnar numpy arrays. Keypoints are stored as an (N, K, 3) array
+    and bboxes as (N, 4), with per-annotation lengths so empty/short lists round trip exactly.
+    """
+    images = coco.images
+    annotations = coco.annotations
+
+    arrays = {'format_version': np.array([COCO_NPZ_FORMAT_VERSION], dtype=np.int32)}
+
+    arrays['image_id'] = np.array([image.id for image in images], dtype=np.int64)
+    arrays['image_width'] = np.array([image.width for image in images], dtype=np.int32)
+    arrays['image_height'] = np.array([image.height for image in images], dtype=np.int32)
+    arrays['image_file_name'], arrays['image_file_name_offsets'] = _pack_strings([i.file_name for i in images])
+    arrays['image_coco_url'], arrays['image_coco_url_offsets'] = _pack_strings([i.coco_url for i in images])
+
+    for field in ['id', 'image_id', 'category_id', 'ignore', 'iscrowd', 'area', 'num_keypoints']:
+        arrays['annotation_%s' % field] = np.array(
+            [getattr(annotation, field, 0) for annotation in annotations], dtype=np.int64)
+
+    bbox_lengths = np.array([len(annotation.bbox) for annotation in annotations], dtype=np.int8)
+    bbox = np.zeros((len(annotations), 4), dtype=np.int32)
+    for idx, annotation in enumerate(annotations):
+        bbox[idx, :bbox_lengths[idx]] = annotation.bbox
+    arrays['annotation_bbox'] = bbox
+    arrays['annotation_bbox_length'] = bbox_lengths
+
+    keypoints_lengths = np.array([len(getattr(annotation, 'keypoints', [])) for annotation in annotations],
+                                 dtype=np.int32)
+    num_keypoints = int(np.ceil(keypoints_lengths.max() / 3)) if len(annotations) > 0 else 0
+    keypoints = np.zeros((len(annotations), num_keypoints * 3), dtype=np.int32)
+    if len(annotations) > 0 and np.all(keypoints_lengths == num_keypoints * 3):
+        keypoints[:] = [annotation.keypoints for annotation in annotations]
+    else:
+        for idx, annotation in enumerate(annotations):
+            keypoints[idx, :keypoints_lengths[idx]] = getattr(annotation, 'keypoints', [])
+    arrays['annotation_keypoints'] = keypoints.reshape((len(annotations), num_keypoints, 3))
+    arrays['annotation_keypoints_length'] = keypoints_lengths
+
+    categories = json.dumps([category.dict() for category in coco.categories]).encode('utf-8')
+    arrays['categories_json'] = np.frombuffer(categories, dtype=np.uint8)
+
+    return arrays
+
+
+def save_coco_npz(coco, file_path):
+    """Save a Coco model as an uncompressed .npz, members are stored so they can be memory-mapped on load"""
+    with open(file_path, 'wb') as f:
+        np.savez(f, **coco_to_arrays(coco))
+
+
+def _memmap_npz(file_path):
+    arrays = {}
+    with zipfile.ZipFile(file_path) as zf, open(file_path, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise Exception("%s member '%s' is compressed and can't be memory-mapped" % (file_path, info.filename))
+
+            # Member data follows its local file header, whose name/extra lengths can differ from the central directory
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(file_path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+
+    return arrays
+
+
+def load_coco_npz(file_path, mmap=True):
+    """
+    Load the columnar arrays of a coco .npz
+
+    :param mmap: memory-map the arrays rather than reading them into memory
+    :return: dict of array name -> numpy array
+    """
+    if mmap:
+        arrays = _memmap_npz(file_path)
+    else:
+        with np.load(file_path) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+
+    if int(arrays['format_version'][0]) != COCO_NPZ_FORMAT_VERSION:
+        raise Exception("Unsupported coco .npz format version %s" % int(arrays['format_version'][0]))
+
+    return arrays
+
+
+def iter_coco_arrays(arrays):
+    """
+    Rebuild model records from columnar arrays
+
+    :return: generator of (section, record) tuples, e.g. ('annotations', KeypointAnnotation)
+    """
+    image_ids = arrays['image_id'].tolist()
+    image_widths = arrays['image_width'].tolist()
+    image_heights = arrays['image_height'].tolist()
+    file_names = _unpack_strings(arrays['image_file_name'], arrays['image_file_name_offsets'])
+    coco_urls = _unpack_strings(arrays['image_coco_url'], arrays['image_coco_url_offsets'])
+    for idx in range(len(image_ids)):
+        yield 'images', Image.construct(id=image_ids[idx], file_name=file_names[idx], coco_url=coco_urls[idx],
+                                        width=image_widths[idx], height=image_heights[idx])
+
+    fields = ['id', 'image_id', 'category_id', 'ignore', 'iscrowd', 'area', 'num_keypoints']
+    columns = {field: arrays['annotation_%s' % field].tolist() for field in fields}
+    bbox_lengths = arrays['annotation_bbox_length'].tolist()
+    keypoints_lengths = arrays['annotation_keypoints_length'].tolist()
+    num_annotations = len(columns['id'])
+    # Convert in blocks so memory-mapped keypoints never have to be materialized as Python lists all at once
+    block_size = 65536
+    for block_start in range(0, num_annotations, block_size):
+        block_end = min(block_start + block_size, num_annotations)
+        bboxes = np.asarray(arrays['annotation_bbox'][block_start:block_end]).tolist()
+        keypoints = np.asarray(arrays['annotation_keypoints'][block_start:block_end]).reshape(
+            (block_end - block_start, -1)).tolist()
+
+        for idx in range(block_start, block_end):
+            values = {field: columns[field][idx] for field in fields}
+            values['bbox'] = bboxes[idx - block_start][:bbox_lengths[idx]]
+            values['keypoints'] = keypoints[idx - block_start][:keypoints_lengths[idx]]
+            yield 'annotations', KeypointAnnotation.construct(**values)
+
+    for category in json.loads(np.asarray(arrays['categories_json']).tobytes().decode('utf-8')):
+        category_class = KeypointCategory if 'keypoints' in category else BaseCategory
+        yield 'categories', category_class(**category)
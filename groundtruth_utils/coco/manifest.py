@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+
+from ..log import logger
+from .models.annotation import KeypointAnnotation
+from .models.image import Image
+from .reader import iter_coco_json
+from .writer import open_coco_file, replace_coco_file, temp_coco_file
+
+COCO_MANIFEST_VERSION = 2
+
+
+def image_input_hash(contributions, separate_by_annotation=False, probe_dimensions=False):
+    """
+    Hash everything a source image's coco records are generated from
+
+    :param contributions: list of (job fingerprint, is incomplete, platform image JSON) tuples, one per job the
+                          image appears in, in config order
+    :param probe_dimensions: whether image width/height are probed, records generated without probing have
+                             zero dimensions
+    """
+    digest = hashlib.sha256(b'separate' if separate_by_annotation else b'combine')
+    if probe_dimensions:
+        # Only added when set, so hashes recorded by runs without probing stay valid
+        digest.update(b'\0probe-dimensions')
+    for fingerprint, incomplete, image_json in contributions:
+        digest.update(b'\0' + fingerprint.encode('utf-8'))
+        digest.update(b'\0' + (b'incomplete' if incomplete else b'complete'))
+        digest.update(b'\0' + image_json.encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+class CocoManifest:
+    """
+    Records, per source image (normalized external id), the hash of its generation inputs along with the ids of the
+    coco image and annotation records generated from it, and the coco files those records were written to. Used by
+    incremental generate-coco runs to reuse the records of unchanged images, read back from the previous run's
+    output, and to keep image/annotation ids stable across runs.
+
+    Stored as (optionally gzipped) JSON, entries that aren't set during a run are dropped when it's saved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self._previous = {}
+        self._entries = {}
+        self._outputs = []
+        self._image_ids = {}
+        self._annotation_ids = {}
+        self.next_image_id = 1
+        self.next_annotation_id = 0
+
+        if os.path.exists(path):
+            with open_coco_file(path, 'r') as f:
+                manifest = json.load(f)
+
+            version = manifest.get('version')
+            if version == 1:
+                # Version 1 embedded the full records, only their ids are carried over and every image is regenerated
+                logger.warning("Coco manifest %s predates version %d, regenerating all images" % (
+                    path, COCO_MANIFEST_VERSION))
+                entries = {external_id: {
+                    'hash': None,
+                    'images': [{
+                        'file_name': image['image']['file_name'],
+                        'id': image['image']['id'],
+                        'annotations': [[external_annotation_id, annotation['id']]
+                                        for external_annotation_id, annotation in image['annotations']]
+                    } for image in entry['images']]
+                } for external_id, entry in manifest['entries'].items()}
+            elif version == COCO_MANIFEST_VERSION:
+                entries = manifest['entries']
+                self._outputs = manifest['outputs']
+            else:
+                raise Exception("Unsupported coco manifest version %s in %s" % (version, path))
+
+            missing_outputs = [output for output in self._outputs if not os.path.exists(output)]
+            if len(missing_outputs) > 0:
+                logger.warning("Coco files %s written by the previous run are missing, regenerating all images" %
+                               ", ".join(missing_outputs))
+                self._outputs = []
+                for entry in entries.values():
+                    entry['hash'] = None
+
+            self._previous = entries
+            self.next_image_id = manifest['next_image_id']
+            self.next_annotation_id = manifest['next_annotation_id']
+
+            for entry in self._previous.values():
+                for image in entry['images']:
+                    self._image_ids[image['file_name']] = image['id']
+                    for external_annotation_id, annotation_id in image['annotations']:
+                        self._annotation_ids[(image['file_name'], external_annotation_id)] = annotation_id
+
+    def __len__(self):
+        return len(self._previous)
+
+    def is_unchanged(self, external_id, input_hash):
+        return external_id in self._previous and self._previous[external_id]['hash'] == input_hash
+
+    def image_id(self, file_name):
+        """Id of the image from the previous run, or a new id that has never been handed out"""
+        if file_name not in self._image_ids:
+            self._image_ids[file_name] = self.next_image_id
+            self.next_image_id += 1
+
+        return self._image_ids[file_name]
+
+    def annotation_id(self, file_name, external_annotation_id):
+        key = (file_name, external_annotation_id)
+        if key not in self._annotation_ids:
+            self._annotation_ids[key] = self.next_annotation_id
+            self.next_annotation_id += 1
+
+        return self._annotation_ids[key]
+
+    def keep(self, external_id):
+        """Carry an unchanged entry over from the previous run"""
+        self._entries[external_id] = self._previous[external_id]
+
+    def set(self, external_id, input_hash, images):
+        """
+        :param images: list of (coco Image, [(external annotation id, coco Annotation), ...]) tuples
+        """
+        self._entries[external_id] = {
+            'hash': input_hash,
+            'images': [{
+                'file_name': image.file_name,
+                'id': image.id,
+                'annotations': [[external_annotation_id, annotation.id]
+                                for external_annotation_id, annotation in annotations]
+            } for image, annotations in images]
+        }
+
+    def previous_records(self, external_ids):
+        """
+        Read the records of source images back from the coco files written by the previous run. Source images
+        whose records aren't all found there, with the ids recorded in the manifest, are left out.
+
+        :return: dict of external id -> list of (coco Image, [coco KeypointAnnotation, ...]) tuples
+        """
+        wanted_images = {}
+        for external_id in external_ids:
+            for image in self._previous[external_id]['images']:
+                wanted_images[image['id']] = image['file_name']
+
+        images = {}
+        annotations = {}
+        for output in self._outputs:
+            for section, record in iter_coco_json(output):
+                if section == 'images':
+                    if wanted_images.get(record['id']) == record['file_name']:
+                        # Records were validated when generated, construct() keeps their values exactly as written
+                        images[record['id']] = Image.construct(**record)
+                elif section == 'annotations':
+                    if record['image_id'] in wanted_images:
+                        annotations.setdefault(record['image_id'], []).append(
+                            KeypointAnnotation.construct(**record))
+
+        records = {}
+        for external_id in external_ids:
+            image_records = []
+            for image in self._previous[external_id]['images']:
+                image_annotations = annotations.get(image['id'], [])
+                if image['id'] not in images or \
+                        set(annotation.id for annotation in image_annotations) != \
+                        set(annotation_id for _, annotation_id in image['annotations']):
+                    logger.warning("%s - Records not found in the previous coco files, regenerating" % external_id)
+                    break
+
+                image_records.append((images[image['id']], image_annotations))
+            else:
+                records[external_id] = image_records
+
+        return records
+
+    def save(self, outputs):
+        """
+        :param outputs: paths of the coco files this run's records were written to
+        """
+        manifest = {
+            'version': COCO_MANIFEST_VERSION,
+            'next_image_id': self.next_image_id,
+            'next_annotation_id': self.next_annotation_id,
+            'outputs': [os.path.abspath(output) for output in outputs],
+            'entries': self._entries
+        }
+
+        temp_path = temp_coco_file(self.path)
+        try:
+            with open_coco_file(temp_path, 'w') as f:
+                json.dump(manifest, f)
+            replace_coco_file(temp_path, self.path)
+        except Exception as e:
+            os.remove(temp_path)
+            raise e
@@ -6,7 +6,7 @@ from typing import List
 
 from groundtruth_utils.log import logger
 
-from .category import KeypointCategory
+from .category import COCO_17_KEYPOINT_INDEX, KeypointCategory
 
 
 class Annotation(BaseModel):
@@ -36,12 +36,11 @@ class KeypointAnnotation(Annotation):
         VISIBILITY_LABELED_VISIBLE = 2
 
     def get_keypoint_index(self, category: KeypointCategory):
-        keypoint_categories = KeypointCategory.coco_17_person_keypoint_categories()
-        if category.name not in keypoint_categories:
+        if category.name not in COCO_17_KEYPOINT_INDEX:
             logger.warn("keypoint category '%s' not found, not capturing keypoint" % category)
             return
 
-        return keypoint_categories.index(category.name) * 3
+        return COCO_17_KEYPOINT_INDEX[category.name] * 3
 
     def add_keypoint(self, category: KeypointCategory, x: int, y: int, visibility: Visibility):
         keypoint_index = self.get_keypoint_index(category)
@@ -1,27 +1,24 @@
 from enum import Enum
+from types import MappingProxyType
 
 from pydantic import BaseModel
 from typing import List
 
 
 def get_coco_category_by_id(id):
-    category = [p for p in all_coco_categories() if p.id == id]
-    if len(category) > 0:
-        return category[0]
-    else:
-        return None
+    return COCO_CATEGORIES_BY_ID.get(id)
 
 
 def get_coco_category(name):
-    category = [p for p in all_coco_categories() if p.name.lower() == name.lower()]
-    if len(category) > 0:
-        return category[0]
-    else:
-        return None
+    return COCO_CATEGORIES_BY_NAME.get(name.lower())
 
 
 def all_coco_categories():
-    return [
+    return list(_build_coco_categories())
+
+
+def _build_coco_categories():
+    return (
         KeypointCategory(
             id=1,
             name="person",
@@ -42,7 +39,7 @@ def all_coco_categories():
             supercategory="person",
             keypoints=KeypointCategory.coco_17_person_keypoint_categories(),
             skeleton=KeypointCategory.coco_17_person_skeleton()
-        )]
+        ))
 
 
 class BaseCategory(BaseModel):
@@ -94,13 +91,10 @@ class KeypointCategory(BaseCategory):
     # This function and the setattr below manually rewrite "__new__" once
     # more after Python
     def KeypointLookup(cls, value):
-        keys = cls.__members__.keys()
         if isinstance(value, str):
-            key = value.replace(' ', '_').upper()
-            if key in keys:
-                return getattr(cls, key)
-        elif isinstance(value, int) and 0 < value <= len(keys):
-            return list(cls.__members__.values())[value - 1]
+            return KEYPOINTS_BY_KEY.get(value.replace(' ', '_').upper())
+        elif isinstance(value, int):
+            return KEYPOINTS_BY_ID.get(value)
         else:
             return None
 
@@ -202,3 +196,35 @@ class KeypointCategory(BaseCategory):
             [KeypointCategory.Keypoint.NECK.id, KeypointCategory.Keypoint.LEFT_SHOULDER.id],
             [KeypointCategory.Keypoint.NECK.id, KeypointCategory.Keypoint.RIGHT_SHOULDER.id]
         ]
+
+
+class _SharedKeypointCategory(KeypointCategory):
+    """Category instance shared through the lookup tables, assigning a field raises a TypeError"""
+
+    class Config:
+        allow_mutation = False
+
+
+def _shared_category(category):
+    # Tuples keep the keypoint and skeleton lists from being changed in place either
+    return _SharedKeypointCategory.construct(
+        **dict(category.dict(), keypoints=tuple(category.keypoints),
+               skeleton=tuple(tuple(limb) for limb in category.skeleton)))
+
+
+# Lookup tables below are built once at import, CocoGenerator and the Labelbox
+# ontology conversion hit them for every keypoint of every annotation.
+# Shared category instances are immutable, use all_coco_categories() for copies
+# that can be changed.
+COCO_CATEGORIES = tuple(_shared_category(category) for category in _build_coco_categories())
+COCO_CATEGORIES_BY_ID = MappingProxyType({category.id: category for category in COCO_CATEGORIES})
+COCO_CATEGORIES_BY_NAME = MappingProxyType({category.name.lower(): category for category in COCO_CATEGORIES})
+
+# Keyed by enum member name ('LEFT_EYE'), which KeypointLookup derives from
+# both names ('left_eye') and labels ('Left Eye')
+KEYPOINTS_BY_KEY = MappingProxyType(dict(KeypointCategory.Keypoint.__members__))
+KEYPOINTS_BY_ID = MappingProxyType({keypoint.id: keypoint for keypoint in KeypointCategory.Keypoint})
+KEYPOINT_LABELS = MappingProxyType(
+    {keypoint: keypoint.name.replace('_', ' ').title() for keypoint in KeypointCategory.Keypoint})
+COCO_17_KEYPOINT_INDEX = MappingProxyType(
+    {name: idx for idx, name in enumerate(KeypointCategory.coco_17_person_keypoint_categories())})
@@ -1,19 +1,140 @@
-from pydantic import BaseModel
-import random
+from pydantic import BaseModel, Field, PrivateAttr, validator
 from typing import List
 
 from .annotation import Annotation, KeypointAnnotation
-from .category import BaseCategory
+from .category import BaseCategory, KeypointCategory
 from .image import Image
+from ..columnar import is_coco_npz, iter_coco_arrays, load_coco_npz, save_coco_npz
+from ..reader import iter_coco_json
+from ..split import split_image_positions
+
+
+_ANNOTATION_INT_FIELDS = ['id', 'image_id', 'ignore', 'area', 'iscrowd', 'category_id', 'num_keypoints']
+_ANNOTATION_INT_LIST_FIELDS = ['bbox', 'keypoints']
+
+
+def _keypoint_annotation_from_record(record):
+    """
+    Build a KeypointAnnotation from a coco JSON record, coercing values the way validation would but
+    skipping pydantic's per-element list validation, which dominates load time for large files
+    """
+    if 'image_id' not in record or 'category_id' not in record:
+        return KeypointAnnotation(**record)
+
+    values = {field: int(record[field]) for field in _ANNOTATION_INT_FIELDS if field in record}
+    for field in _ANNOTATION_INT_LIST_FIELDS:
+        if field in record:
+            values[field] = [int(v) for v in record[field]]
+
+    return KeypointAnnotation.construct(**values)
+
+
+class RecordList(list):
+    """
+    list that counts the mutations which aren't plain appends (inserts, removals, item assignment, sorting...),
+    so an index over it can catch up on appends and knows when it has to be rebuilt
+    """
+    version = 0
+
+    def _mutated(self):
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._mutated()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._mutated()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        result = super().__imul__(n)
+        self._mutated()
+        return result
+
+    def insert(self, index, value):
+        super().insert(index, value)
+        self._mutated()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._mutated()
+        return value
+
+    def remove(self, value):
+        super().remove(value)
+        self._mutated()
+
+    def clear(self):
+        super().clear()
+        self._mutated()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._mutated()
+
+    def reverse(self):
+        super().reverse()
+        self._mutated()
 
 
 class Coco(BaseModel):
-    images: List[Image] = []
-    annotations: List[Annotation] = []
-    categories: List[BaseCategory] = []
+    images: List[Image] = Field(default_factory=RecordList)
+    annotations: List[Annotation] = Field(default_factory=RecordList)
+    categories: List[BaseCategory] = Field(default_factory=RecordList)
+
+    # Lookup indexes are built lazily and caught up incrementally when records are appended to
+    # images/annotations/categories. Any other change to a list, or replacing it, triggers a full rebuild
+    _images_by_file_name: dict = PrivateAttr(default_factory=dict)
+    _annotations_by_image_id: dict = PrivateAttr(default_factory=dict)
+    _categories_by_id: dict = PrivateAttr(default_factory=dict)
+    _indexed: dict = PrivateAttr(default_factory=dict)
+
+    @validator('images', 'annotations', 'categories')
+    def record_list(cls, records):
+        return RecordList(records)
+
+    def _sync_index(self, field, index, key):
+        records = getattr(self, field)
+        if not isinstance(records, RecordList):
+            # The list was assigned directly, bypassing validation, track its changes from now on
+            records = RecordList(records)
+            self.__dict__[field] = records
+
+        indexed_records, indexed_version, num_indexed = self._indexed.get(field, (None, 0, 0))
+        if indexed_records is not records or records.version != indexed_version or len(records) < num_indexed:
+            index.clear()
+            num_indexed = 0
+
+        for idx in range(num_indexed, len(records)):
+            index.setdefault(key(records[idx]), []).append(records[idx])
+
+        self._indexed[field] = (records, records.version, len(records))
+        return index
+
+    def images_by_file_name(self):
+        return self._sync_index('images', self._images_by_file_name, lambda i: i.file_name)
+
+    def annotations_by_image_id(self):
+        return self._sync_index('annotations', self._annotations_by_image_id, lambda a: a.image_id)
+
+    def categories_by_id(self):
+        return self._sync_index('categories', self._categories_by_id, lambda c: c.id)
 
     def get_annotations_for_image(self, image_id):
-        return list(filter(lambda a: a.image_id == image_id, self.annotations))
+        return list(self.annotations_by_image_id().get(image_id, []))
+
+    def get_image_by_file_name(self, file_name):
+        images = self.images_by_file_name().get(file_name)
+        return images[0] if images else None
+
+    def get_category(self, category_id):
+        categories = self.categories_by_id().get(category_id)
+        return categories[0] if categories else None
 
     def load_pycoco(self, pycoco):
         for image in pycoco.loadImgs(pycoco.getImgIds()):
@@ -38,25 +159,65 @@ class Coco(BaseModel):
                     num_keypoints=annotation['num_keypoints']
                 ))
 
-    def split(self, percent=0.0):
+    def load_json(self, file_path, load_categories=True):
+        """
+        Stream a coco JSON file (optionally gzipped) straight into this model in one pass,
+        without pycocotools building its own index of the whole file first
+        """
+        for section, record in iter_coco_json(file_path):
+            if section == 'images':
+                self.images.append(Image(
+                    **{field: record[field] for field in Image.__fields__ if field in record}))
+            elif section == 'annotations':
+                self.annotations.append(_keypoint_annotation_from_record(record))
+            elif section == 'categories' and load_categories:
+                category_class = KeypointCategory if 'keypoints' in record else BaseCategory
+                self.categories.append(category_class(
+                    **{field: record[field] for field in category_class.__fields__ if field in record}))
+
+    def load_npz(self, file_path, load_categories=True, mmap=True):
+        """Load a binary columnar coco dataset (see columnar.save_coco_npz) into this model"""
+        for section, record in iter_coco_arrays(load_coco_npz(file_path, mmap=mmap)):
+            if section == 'categories' and not load_categories:
+                continue
+            getattr(self, section).append(record)
+
+    def load_file(self, file_path, load_categories=True):
+        """Load a coco dataset from either a JSON (optionally gzipped) or binary .npz file"""
+        if is_coco_npz(file_path):
+            self.load_npz(file_path, load_categories=load_categories)
+        else:
+            self.load_json(file_path, load_categories=load_categories)
+
+    def save_npz(self, file_path):
+        save_coco_npz(self, file_path)
+
+    def split(self, percent=0.0, seed=None, stratify=False, group_key=None):
+        """
+        Split into a front ('percent' share of images) and back Coco model, see split.split_image_positions
+
+        :return: [coco_front, coco_back]
+        """
         if percent == 0.0:
             return [self, None]
 
-        random.shuffle(self.images)
+        front_positions = split_image_positions(
+            [(image, self.get_annotations_for_image(image.id)) for image in self.images],
+            percent,
+            seed=seed,
+            stratify=stratify,
+            group_key=group_key)
 
-        cut = round(len(self.images) * percent)
-        coco_front = Coco(images=self.images[:cut], categories=self.categories)
-        coco_back = Coco(images=self.images[cut:], categories=self.categories)
+        coco_front = Coco(images=[image for position, image in enumerate(self.images) if position in front_positions],
+                          categories=self.categories)
+        coco_back = Coco(images=[image for position, image in enumerate(self.images) if position not in front_positions],
+                         categories=self.categories)
 
+        front_image_ids = set(image.id for image in coco_front.images)
         for ann in self.annotations:
-            matched = False
-            for img in coco_front.images:
-                if ann.image_id == img.id:
-                    matched = True
-                    coco_front.annotations.append(ann)
-                    break
-
-            if not matched:
+            if ann.image_id in front_image_ids:
+                coco_front.annotations.append(ann)
+            else:
                 coco_back.annotations.append(ann)
 
         return [coco_front, coco_back]
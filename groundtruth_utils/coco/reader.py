@@ -0,0 +1,102 @@
+import json
+import re
+
+from .writer import open_coco_file
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+class _JsonStream:
+    """Incrementally decodes JSON values from a file, only ever holding the current chunk plus one partial value"""
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character, '' at the end of the file"""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self._fill():
+                return ''
+
+    def take(self, expected):
+        char = self.peek()
+        if char not in expected:
+            raise ValueError("Malformed coco JSON, expected one of '%s' but found '%s'" % (expected, char))
+
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+                # A number running into the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            if not self._fill():
+                value, self.pos = self._decoder.raw_decode(self.buffer, self.pos)
+                return value
+
+
+def iter_coco_json(file_path, chunk_size=1 << 20):
+    """
+    Stream a coco JSON file (optionally gzipped) without loading it whole.
+
+    Elements of top-level arrays ('images', 'annotations', 'categories', ...) are yielded one at a time,
+    any other top-level value is yielded whole.
+
+    :return: generator of (section, record) tuples, e.g. ('annotations', {...})
+    """
+    with open_coco_file(file_path, 'r') as fp:
+        stream = _JsonStream(fp, chunk_size)
+
+        stream.take('{')
+        if stream.peek() == '}':
+            return
+
+        while True:
+            section = stream.value()
+            stream.take(':')
+
+            if stream.peek() == '[':
+                stream.take('[')
+                if stream.peek() == ']':
+                    stream.take(']')
+                else:
+                    while True:
+                        yield section, stream.value()
+                        if stream.take(',]') == ']':
+                            break
+            else:
+                yield section, stream.value()
+
+            if stream.take(',}') == '}':
+                break
@@ -0,0 +1,143 @@
+from collections import Counter
+import heapq
+import random
+import re
+
+from .models.annotation import KeypointAnnotation
+
+
+def image_group_key(group_pattern):
+    """
+    Build a group key function from a regex applied to image file names, e.g. to keep a classroom or camera
+    in a single split. The first capture group (or the whole match) is the key, unmatched images form their own group.
+    """
+    regex = re.compile(group_pattern)
+
+    def group_key(image):
+        m = regex.search(image.file_name)
+        if m is None:
+            return image.file_name
+
+        return m.group(1) if regex.groups > 0 else m.group(0)
+
+    return group_key
+
+
+def split_features(annotations):
+    """Count the annotations by category and keypoints by (keypoint, visibility) for stratified splits"""
+    features = Counter()
+    for annotation in annotations:
+        features['category:%s' % annotation.category_id] += 1
+
+        if isinstance(annotation, KeypointAnnotation):
+            for keypoint_idx, visibility in enumerate(annotation.keypoints[2::3]):
+                if visibility != KeypointAnnotation.Visibility.VISIBILITY_NOT_LABELED:
+                    features['keypoint:%d:%d' % (keypoint_idx, visibility)] += 1
+
+    return features
+
+
+def split_image_positions(images, percent, seed=None, stratify=False, group_key=None):
+    """
+    Choose which images belong to the front ('percent') share of a split. Runs in linear time.
+
+    :param images: list of (image, annotations) tuples
+    :param percent: share of images that should land in the front split
+    :param seed: seed for the split's random number generator, None for a random split
+    :param stratify: balance category and keypoint-visibility counts across the split rather than only image counts
+    :param group_key: optional function mapping an image to a group, groups are never divided across the split
+    :return: set of positions (indexes into images) that belong to the front split
+    """
+    rng = random.Random(seed)
+
+    groups = {}
+    for position, (image, _) in enumerate(images):
+        key = group_key(image) if group_key is not None else position
+        groups.setdefault(key, []).append(position)
+
+    keys = list(groups.keys())
+    rng.shuffle(keys)
+
+    front_positions = set()
+    if not stratify:
+        cut = round(len(images) * percent)
+        for key in keys:
+            group_size = len(groups[key])
+            if abs(len(front_positions) + group_size - cut) < abs(len(front_positions) - cut):
+                front_positions.update(groups[key])
+
+        return front_positions
+
+    features = {}
+    totals = Counter()
+    for key in keys:
+        features[key] = Counter({'images': len(groups[key])})
+        for position in groups[key]:
+            features[key].update(split_features(images[position][1]))
+        totals.update(features[key])
+
+    # Iterative stratification (Sechidis et al.): work through features rarest first, handing each group that
+    # carries the feature to whichever split still wants the most of it, then fall back to image counts
+    desired = {
+        True: Counter({feature: total * percent for feature, total in totals.items()}),
+        False: Counter({feature: total * (1.0 - percent) for feature, total in totals.items()})
+    }
+
+    groups_by_feature = {}
+    for key in keys:
+        for feature in features[key]:
+            groups_by_feature.setdefault(feature, []).append(key)
+
+    remaining = Counter({feature: total for feature, total in totals.items() if feature != 'images'})
+    unassigned = set(keys)
+
+    def assign(key, in_front):
+        unassigned.discard(key)
+        if in_front:
+            front_positions.update(groups[key])
+        for feature, count in features[key].items():
+            desired[in_front][feature] -= count
+            if feature != 'images':
+                remaining[feature] -= count
+
+    def choose(feature):
+        for f in [feature, 'images']:
+            if desired[True][f] != desired[False][f]:
+                return desired[True][f] > desired[False][f]
+        return rng.random() < percent
+
+    while True:
+        pending_features = [feature for feature, count in remaining.items() if count > 0]
+        if len(pending_features) == 0:
+            break
+
+        feature = min(pending_features, key=lambda f: (remaining[f], f))
+        for key in groups_by_feature[feature]:
+            if key in unassigned:
+                assign(key, choose(feature))
+
+    for key in keys:
+        if key in unassigned:
+            assign(key, choose('images'))
+
+    return front_positions
+
+
+def shard_image_positions(images, num_shards):
+    """
+    Assign images to shards so every shard ends up with about the same number of annotations.
+    Images are handed out largest first, each to the shard with the fewest annotations so far.
+
+    :param images: list of (image, annotations) tuples
+    :return: list with the shard index of each image position
+    """
+    shards = [(0, 0, shard_idx) for shard_idx in range(num_shards)]
+    positions = sorted(range(len(images)), key=lambda position: len(images[position][1]), reverse=True)
+
+    image_shards = [0] * len(images)
+    for position in positions:
+        num_annotations, num_images, shard_idx = heapq.heappop(shards)
+        image_shards[position] = shard_idx
+        heapq.heappush(shards, (num_annotations + len(images[position][1]), num_images + 1, shard_idx))
+
+    return image_shards
@@ -0,0 +1,394 @@
+import gzip
+import os
+import stat
+import tempfile
+
+from .split import shard_image_positions, split_image_positions
+
+
+def shard_file_name(file_name, shard_idx, num_shards):
+    """e.g. coco.json.gz -> coco-00001-of-00004.json.gz"""
+    base, gz = (file_name[:-3], '.gz') if file_name.endswith('.gz') else (file_name, '')
+    base, ext = os.path.splitext(base)
+    return "%s-%05d-of-%05d%s%s" % (base, shard_idx, num_shards, ext, gz)
+
+
+def open_coco_file(file_path, mode='r'):
+    """Open a (optionally gzipped) coco file in text mode, gzip is detected by the '.gz' extension"""
+    if str(file_path).endswith('.gz'):
+        return gzip.open(file_path, "%st" % mode)
+
+    return open(file_path, mode)
+
+
+def temp_coco_file(file_path):
+    """
+    Create an empty temporary file in file_path's directory to write a coco file to, see replace_coco_file
+
+    :return: path of the temporary file, ending in '.gz' when file_path does
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp.gz' if str(file_path).endswith('.gz') else '.tmp')
+    os.close(fd)
+    return temp_path
+
+
+def replace_coco_file(temp_path, file_path):
+    """
+    Move a finished temporary file into place. mkstemp creates files readable only by their owner, the file gets
+    the permissions of the file it replaces or, for a new file, the ones open() would have given it
+    """
+    if os.path.exists(file_path):
+        mode = stat.S_IMODE(os.stat(file_path).st_mode)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+    os.chmod(temp_path, mode)
+    os.replace(temp_path, file_path)
+
+
+class CocoModelWriter:
+    """Collects streamed coco records into an in-memory Coco model"""
+
+    def __init__(self, coco):
+        self.coco = coco
+
+    def start(self, num_images=None, images=None):
+        pass
+
+    def write_image(self, image):
+        self.coco.images.append(image)
+
+    def write_annotation(self, annotation):
+        self.coco.annotations.append(annotation)
+
+    def stage(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+    def remove_outputs(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class CocoJsonWriter:
+    """
+    Writes a coco dataset to a JSON file one record at a time rather than serializing a Coco model in one go.
+    Only the writer's own copy of the records is kept out of memory, how many records a caller builds up before
+    writing them is up to the caller.
+
+    Images and annotations are spooled to a temporary file on disk, one record per line, until the writer is
+    closed. The output is then written in one go, keeping the images/annotations/categories layout of
+    Coco.json(), so an open writer only holds a single file descriptor. Output is gzipped when the file name
+    ends in '.gz'.
+
+    The file is written under a temporary name in the same directory and only moved into place once it's
+    complete, a writer that's aborted (or exits its with block on an exception) leaves nothing behind. close() is
+    stage() (write the temporary file) followed by commit() (move it into place), so writers combining several
+    outputs can stage all of them before committing any.
+    """
+
+    def __init__(self, file_path, categories=None):
+        self.file_path = file_path
+        self.categories = categories or []
+
+        self.num_images = 0
+        self.num_annotations = 0
+
+        self._spool = tempfile.TemporaryFile(mode='w+')
+        self._staged_path = None
+
+    def start(self, num_images=None, images=None):
+        pass
+
+    def write_image(self, image):
+        # Record JSON never contains a raw newline, the first character tags the record type
+        self._spool.write("i%s\n" % image.json())
+        self.num_images += 1
+
+    def write_annotation(self, annotation):
+        self._spool.write("a%s\n" % annotation.json())
+        self.num_annotations += 1
+
+    def _copy_records(self, f, tag):
+        self._spool.seek(0)
+        separator = ''
+        for line in self._spool:
+            if line[0] == tag:
+                f.write(separator)
+                f.write(line[1:-1])
+                separator = ', '
+
+    def stage(self):
+        """Write the complete output to a temporary file next to file_path, commit() moves it into place"""
+        if self._spool is None:
+            return
+
+        temp_path = temp_coco_file(self.file_path)
+        try:
+            with open_coco_file(temp_path, 'w') as f:
+                f.write('{"images": [')
+                self._copy_records(f, 'i')
+                f.write('], "annotations": [')
+                self._copy_records(f, 'a')
+                f.write('], "categories": [')
+                f.write(', '.join(category.json() for category in self.categories))
+                f.write(']}')
+        except Exception as e:
+            os.remove(temp_path)
+            self.abort()
+            raise e
+
+        self._spool.close()
+        self._spool = None
+        self._staged_path = temp_path
+
+    def commit(self):
+        if self._staged_path is None:
+            return
+
+        try:
+            replace_coco_file(self._staged_path, self.file_path)
+        except Exception as e:
+            self.abort()
+            raise e
+        self._staged_path = None
+
+    def close(self):
+        self.stage()
+        self.commit()
+
+    def abort(self):
+        """Discard everything written or staged so far, without writing the output file"""
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+        if self._staged_path is not None:
+            try:
+                os.remove(self._staged_path)
+            except OSError:
+                pass
+            self._staged_path = None
+
+    def remove_outputs(self):
+        """Remove the committed output file"""
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class CocoSplitWriter:
+    """
+    Streams records into two writers, sending a random 'percent' share of images (and their annotations)
+    to the front writer and everything else to the back writer. Mirrors Coco.split() without holding the dataset.
+
+    Stratified and grouped splits need the upcoming (image, annotations) pairs passed to start().
+    """
+
+    def __init__(self, front_writer, back_writer, percent=0.0, seed=None, stratify=False, group_key=None):
+        self.front_writer = front_writer
+        self.back_writer = back_writer
+        self.percent = percent
+        self.seed = seed
+        self.stratify = stratify
+        self.group_key = group_key
+
+        self._front_positions = None
+        self._front_image_ids = set()
+        self._image_position = 0
+
+    def start(self, num_images=None, images=None):
+        if images is None:
+            if self.stratify or self.group_key is not None:
+                raise Exception("CocoSplitWriter requires the upcoming images for stratified or grouped splits")
+            if num_images is None:
+                raise Exception("CocoSplitWriter requires the number of images up front")
+
+            self._front_positions = split_image_positions([(None, [])] * num_images, self.percent, seed=self.seed)
+            self.front_writer.start(len(self._front_positions))
+            self.back_writer.start(num_images - len(self._front_positions))
+            return
+
+        self._front_positions = split_image_positions(
+            images, self.percent, seed=self.seed, stratify=self.stratify, group_key=self.group_key)
+
+        front_images = [pair for position, pair in enumerate(images) if position in self._front_positions]
+        back_images = [pair for position, pair in enumerate(images) if position not in self._front_positions]
+        self.front_writer.start(len(front_images), images=front_images)
+        self.back_writer.start(len(back_images), images=back_images)
+
+    def write_image(self, image):
+        if self._image_position in self._front_positions:
+            self._front_image_ids.add(image.id)
+            self.front_writer.write_image(image)
+        else:
+            self.back_writer.write_image(image)
+        self._image_position += 1
+
+    def write_annotation(self, annotation):
+        if annotation.image_id in self._front_image_ids:
+            self.front_writer.write_annotation(annotation)
+        else:
+            self.back_writer.write_annotation(annotation)
+
+    def stage(self):
+        try:
+            self.front_writer.stage()
+            self.back_writer.stage()
+        except Exception as e:
+            self.abort()
+            raise e
+
+    def commit(self):
+        self.front_writer.commit()
+        try:
+            self.back_writer.commit()
+        except Exception as e:
+            # Don't leave one half of a split behind
+            self.front_writer.remove_outputs()
+            raise e
+
+    def close(self):
+        """Both outputs are fully written before either is moved into place, so they're committed together"""
+        self.stage()
+        self.commit()
+
+    def abort(self):
+        self.front_writer.abort()
+        self.back_writer.abort()
+
+    def remove_outputs(self):
+        self.front_writer.remove_outputs()
+        self.back_writer.remove_outputs()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class CocoShardWriter:
+    """
+    Streams records into a set of shard writers, balancing shards by annotation count. Each image's
+    annotations follow it into its shard.
+
+    Balancing needs the upcoming (image, annotations) pairs passed to start(), when only the number of
+    images is known images are dealt out round-robin.
+    """
+
+    def __init__(self, shard_writers):
+        self.shard_writers = shard_writers
+
+        self._image_shards = None
+        self._image_position = 0
+        self._current_writer = None
+
+    def start(self, num_images=None, images=None):
+        if images is not None:
+            self._image_shards = shard_image_positions(images, len(self.shard_writers))
+        elif num_images is not None:
+            self._image_shards = [position % len(self.shard_writers) for position in range(num_images)]
+        else:
+            raise Exception("CocoShardWriter requires the number of images up front")
+
+        for shard_idx, shard_writer in enumerate(self.shard_writers):
+            shard_positions = [p for p, shard in enumerate(self._image_shards) if shard == shard_idx]
+            shard_writer.start(len(shard_positions),
+                               images=[images[p] for p in shard_positions] if images is not None else None)
+
+    def write_image(self, image):
+        self._current_writer = self.shard_writers[self._image_shards[self._image_position]]
+        self._current_writer.write_image(image)
+        self._image_position += 1
+
+    def write_annotation(self, annotation):
+        self._current_writer.write_annotation(annotation)
+
+    def index(self):
+        """Describe the shards, file names are relative to the shard files' directory"""
+        shards = [{
+            'file_name': os.path.basename(shard_writer.file_path),
+            'num_images': shard_writer.num_images,
+            'num_annotations': shard_writer.num_annotations
+        } for shard_writer in self.shard_writers]
+
+        return {
+            'num_shards': len(shards),
+            'num_images': sum(shard['num_images'] for shard in shards),
+            'num_annotations': sum(shard['num_annotations'] for shard in shards),
+            'shards': shards
+        }
+
+    def stage(self):
+        try:
+            for shard_writer in self.shard_writers:
+                shard_writer.stage()
+        except Exception as e:
+            self.abort()
+            raise e
+
+    def commit(self):
+        committed_writers = []
+        try:
+            for shard_writer in self.shard_writers:
+                shard_writer.commit()
+                committed_writers.append(shard_writer)
+        except Exception as e:
+            # Don't leave a partial set of shards behind
+            for shard_writer in committed_writers:
+                shard_writer.remove_outputs()
+            self.abort()
+            raise e
+
+    def close(self):
+        """Every shard is fully written before any of them is moved into place"""
+        self.stage()
+        self.commit()
+
+    def abort(self):
+        for shard_writer in self.shard_writers:
+            shard_writer.abort()
+
+    def remove_outputs(self):
+        for shard_writer in self.shard_writers:
+            shard_writer.remove_outputs()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
@@ -1,18 +1,22 @@
-import re
-import requests
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import time
 import yaml
 
-from jsonpath_ng.ext import parse
+from PIL import Image as PILImage
 
 from .annotate import Annotate
 from .coco.models.annotation import KeypointAnnotation as CocoKeypointAnnotation
 from .coco.models.coco import Coco
 from .coco.models.category import KeypointCategory as CocoKeypointCategory, all_coco_categories, get_coco_category
+from .coco.manifest import image_input_hash
 from .coco.models.image import Image as CocoImage
+from .coco.writer import CocoModelWriter
+from .coco_plan import compile_coco_config
 from .helper import *
+from .image_cache import cache_key_url, fetch_image_bytes
 from .log import logger
+from .probe import probe_images_dimensions
 
 
 class CocoGenerator:
@@ -25,160 +29,258 @@ class CocoGenerator:
     def load_config(config_file):
         return yaml.load(config_file, Loader=yaml.FullLoader)
 
+    @staticmethod
+    def compile_config(config):
+        return compile_coco_config(config)
+
     def load_data_from_platform(self, platform, config_file, separate_by_annotation=False,
-                                filter_min_confidence=0.0, filter_min_labelers=3):
+                                filter_min_confidence=0.0, filter_min_labelers=3, max_workers=4, writer=None,
+                                probe_dimensions=False, probe_workers=16, manifest=None):
+        """
+        :param writer: optional coco record writer (see coco.writer), records are collected into this generator's
+                       Coco model when no writer is given. Either way every image's records are built in memory
+                       before the first one is written, images from later jobs can add annotations to earlier ones.
+                       A writer saves the Coco model and its JSON string on top of them, not the records themselves
+        :param probe_dimensions: fill image width/height by reading each source image's header (see probe.py)
+        :param manifest: optional CocoManifest (see coco.manifest) for incremental runs, only source images whose
+                         annotations or job config changed since the manifest was saved are regenerated, the others
+                         are read back from the coco files saved with it. Image and annotation ids are kept stable
+                         across runs. The manifest is updated but not saved.
+        """
         config = self.__class__.load_config(config_file)
+        job_plans = self.__class__.compile_config(config)
 
-        coco_images = {}
-        for job_config in config['jobs']:
-            logger.info("Loading '%s' annotations" % job_config['name'])
+        def fetch_job(job_plan):
+            logger.info("Loading '%s' annotations" % job_plan.name)
             active_platform = get_platform(platform)
             valid_images, invalid_images = active_platform.fetch_annotations(
-                job_config['name'],
+                job_plan.name,
                 consolidate=True,
                 filter_min_confidence=filter_min_confidence,
                 filter_min_labelers=filter_min_labelers)
 
             valid_images.set_excluded_null()
+            return valid_images, invalid_images
+
+        # Jobs are fetched concurrently but consumed in config order, so image and annotation ids
+        # come out exactly as they would in a serial run no matter which job finishes first
+        coco_images = {}
+        input_hashes = None
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            if manifest is None:
+                for job_plan, (valid_images, invalid_images) in zip(job_plans, executor.map(fetch_job, job_plans)):
+                    self._load_job_images(job_plan, valid_images, invalid_images, coco_images, separate_by_annotation)
+            else:
+                jobs = list(zip(job_plans, executor.map(fetch_job, job_plans)))
+                input_hashes = self.__class__._image_input_hashes(jobs, separate_by_annotation, probe_dimensions)
+                previous_records = manifest.previous_records(
+                    [external_id for external_id, input_hash in input_hashes.items()
+                     if manifest.is_unchanged(external_id, input_hash)])
+                unchanged_external_ids = set(previous_records.keys())
+                logger.info("Incremental run, regenerating %d of %d source images" % (
+                    len(input_hashes) - len(unchanged_external_ids), len(input_hashes)))
+
+                for job_plan, (valid_images, invalid_images) in jobs:
+                    self._load_job_images(job_plan, valid_images, invalid_images, coco_images, separate_by_annotation,
+                                          skip_external_ids=unchanged_external_ids)
+
+        if probe_dimensions:
+            dimensions = probe_images_dimensions(
+                [coco_image['source_url'] for coco_image in coco_images.values()], max_workers=probe_workers)
+            for coco_image in coco_images.values():
+                if coco_image['source_url'] in dimensions:
+                    coco_image['image'].width, coco_image['image'].height = dimensions[coco_image['source_url']]
+
+        if writer is None:
+            writer = CocoModelWriter(self.coco)
+
+        if manifest is not None:
+            records = self.__class__._merge_manifest_records(manifest, input_hashes, coco_images, previous_records)
+            writer.start(num_images=len(records), images=records)
+            for image, annotations in records:
+                writer.write_image(image)
+                for annotation in annotations:
+                    writer.write_annotation(annotation)
+            return
+
+        writer.start(num_images=len(coco_images),
+                     images=[(coco_image['image'], list(coco_image['annotations'].values()))
+                             for coco_image in coco_images.values()])
+
+        annotation_id = 0
+        for external_id in list(coco_images.keys()):
+            coco_image = coco_images.pop(external_id)
+            writer.write_image(coco_image['image'])
+            for external_annotation_id in coco_image['annotations']:
+                coco_image['annotations'][external_annotation_id].id = annotation_id
+                coco_image['annotations'][external_annotation_id].compute_area()
+                coco_image['annotations'][external_annotation_id].compute_num_keypoints()
+                writer.write_annotation(coco_image['annotations'][external_annotation_id])
+                annotation_id += 1
+
+    @staticmethod
+    def _image_input_json(image):
+        """
+        JSON of the parts of a platform image its coco records are built from. Presigning parameters are dropped
+        from its URL, they change with every export of the same image
+        """
+        return image.copy(update={'url': cache_key_url(image.url)}).json(include={'external_id', 'url', 'annotations'})
+
+    @staticmethod
+    def _image_input_hashes(jobs, separate_by_annotation=False, probe_dimensions=False):
+        """
+        :param jobs: list of (job_plan, (valid_images, invalid_images)) tuples
+        :return: dict of normalized external id -> hash of the inputs its coco records are generated from
+        """
+        contributions = {}
+        for job_plan, (valid_images, invalid_images) in jobs:
+            incomplete_image_ids = job_plan.incomplete_image_ids(invalid_images.images)
+            for image in valid_images.images:
+                external_id = job_plan.normalize_external_id(image.external_id)
+                contributions.setdefault(external_id, []).append(
+                    (job_plan.fingerprint, external_id in incomplete_image_ids,
+                     CocoGenerator._image_input_json(image)))
+
+        return {external_id: image_input_hash(image_contributions, separate_by_annotation, probe_dimensions)
+                for external_id, image_contributions in contributions.items()}
+
+    @staticmethod
+    def _merge_manifest_records(manifest, input_hashes, coco_images, previous_records):
+        """
+        Assign stable ids to the regenerated images, record them in the manifest and merge them with the
+        unchanged images read back from the previous run's output
+
+        :param previous_records: dict of external id -> records of the unchanged source images
+        :return: list of (image, annotations) tuples in source image order
+        """
+        coco_images_by_external_id = {}
+        for coco_image in coco_images.values():
+            coco_images_by_external_id.setdefault(coco_image['external_id'], []).append(coco_image)
+
+        records = []
+        for external_id, input_hash in input_hashes.items():
+            if external_id in previous_records:
+                manifest.keep(external_id)
+                records += previous_records[external_id]
+                continue
+
+            images = []
+            for coco_image in coco_images_by_external_id.get(external_id, []):
+                image = coco_image['image']
+                image.id = manifest.image_id(image.file_name)
 
-            incomplete_image_ids = []
-            for image_idx, image in enumerate(invalid_images.images):
-                external_id = image.external_id
-                if 'externalIdPattern' in job_config:
-                    r = re.compile(job_config['externalIdPattern'])
-                    external_id = ''.join(re.split(r, external_id))
-                incomplete_image_ids.append(external_id)
-
-            image_id = 0
-            for image_idx, image in enumerate(valid_images.images):
-                logger.info("%s - Generating annotations" % image.external_id)
-
-                image_as_dict = image.dict()
-                external_id = image.external_id
-                if 'externalIdPattern' in job_config:
-                    r = re.compile(job_config['externalIdPattern'])
-                    external_id = ''.join(re.split(r, external_id))
-
-                if external_id in incomplete_image_ids:
+                annotations = []
+                for external_annotation_id, annotation in coco_image['annotations'].items():
+                    annotation.id = manifest.annotation_id(image.file_name, external_annotation_id)
+                    annotation.image_id = image.id
+                    annotation.compute_area()
+                    annotation.compute_num_keypoints()
+                    annotations.append((external_annotation_id, annotation))
+
+                images.append((image, annotations))
+                records.append((image, [annotation for _, annotation in annotations]))
+
+            manifest.set(external_id, input_hash, images)
+
+        return records
+
+    def _load_job_images(self, job_plan, valid_images, invalid_images, coco_images, separate_by_annotation=False,
+                         skip_external_ids=None):
+        incomplete_image_ids = job_plan.incomplete_image_ids(invalid_images.images)
+
+        image_id = 0
+        for image_idx, image in enumerate(valid_images.images):
+            logger.info("%s - Generating annotations" % image.external_id)
+
+            external_id = job_plan.normalize_external_id(image.external_id)
+
+            if skip_external_ids is not None and external_id in skip_external_ids:
+                continue
+
+            if external_id in incomplete_image_ids:
+                logger.info(
+                    "%s - Skipping because image still has pending annotations that have not been completed or match filter rules" %
+                    (image.external_id))
+                continue
+
+            annotation_idx = 0
+            all_annotations = []
+            bbox_category = None
+            for rule, matches in job_plan.match(image.annotations):
+                if rule.type == 'bbox':
                     logger.info(
-                        "%s - Skipping because image still has pending annotations that have not been completed or match filter rules" %
-                        (image.external_id))
-                    continue
-
-                annotation_idx = 0
-                all_annotations = []
-                bbox_category = None
-                for annotation_config in job_config['annotations']:
-                    if annotation_config['type'] == 'bbox':
-                        logger.info(
-                            "%s - Parsing bbox annotations for category '%s'" %
-                            (image.external_id, annotation_config['category']))
-                        jsonpath_expr = parse(annotation_config['match'])
-
-                        for idx, match in enumerate(jsonpath_expr.find(image_as_dict['annotations'])):
-                            if not separate_by_annotation and bbox_category is not None:
-                                logger.warning(
-                                    "%s - Combine mode expects a single bbox, multiple bboxes ignored - %s" %
-                                    (image.external_id, annotation_config['category']))
-                                continue
-
-                            bbox_category = annotation_config['category']
-                            all_annotations += [{
-                                'annotation': match.value,
-                                'type': 'bbox',
-                                'category': annotation_config['category'],
-                                'visibility': True
-                            }]
-                    elif annotation_config['type'] == 'keypoint':
-                        if separate_by_annotation:
+                        "%s - Parsing bbox annotations for category '%s'" %
+                        (image.external_id, rule.category))
+
+                    for match in matches:
+                        if not separate_by_annotation and bbox_category is not None:
                             logger.warning(
-                                "%s - 'Separate' by annotation mode ignores keypoints, passing on %s" %
-                                (image.external_id, annotation_config['category']))
+                                "%s - Combine mode expects a single bbox, multiple bboxes ignored - %s" %
+                                (image.external_id, rule.category))
                             continue
 
-                        logger.info("%s - Parsing keypoint visible annotations for category '%s'" %
-                                    (image.external_id, annotation_config['category']))
-                        jsonpath_expr = parse(annotation_config['visible'])
-                        visible_annotations = [
-                            {
-                                'annotation': match.value,
-                                'type': 'keypoint',
-                                'category': annotation_config['category'],
-                                'visibility': CocoKeypointAnnotation.Visibility.VISIBILITY_LABELED_VISIBLE} for match in jsonpath_expr.find(
-                                image_as_dict['annotations'])]
-
-                        logger.info("%s - Parsing keypoint not-visible annotations for category '%s'" %
-                                    (image.external_id, annotation_config['category']))
-                        jsonpath_expr = parse(annotation_config['notVisible'])
-                        not_visible_annotations = [
-                            {
-                                'annotation': match.value,
-                                'type': 'keypoint',
-                                'category': annotation_config['category'],
-                                'visibility': CocoKeypointAnnotation.Visibility.VISIBILITY_LABELED_NOT_VISIBLE} for match in jsonpath_expr.find(
-                                image_as_dict['annotations'])]
-
-                        all_annotations += visible_annotations + not_visible_annotations
-
-                for annotation_match_idx, annotation_match in enumerate(all_annotations):
-                    file_name = external_id
+                        bbox_category = rule.category
+                        all_annotations.append(match)
+                elif rule.type == 'keypoint':
                     if separate_by_annotation:
-                        file_name = get_separated_file_name(file_name, annotation_idx)
-
-                    if file_name not in coco_images:
-                        image_id += 1
-                        coco_images[file_name] = {
-                            'image': CocoImage(
-                                id=image_id,
-                                file_name=file_name,
-                                coco_url=os.path.join(os.path.split(image.url)[0], file_name),
-                                width=0,
-                                height=0),
-                            'annotations': {}}
-
+                        logger.warning(
+                            "%s - 'Separate' by annotation mode ignores keypoints, passing on %s" %
+                            (image.external_id, rule.category))
+                        continue
+
+                    logger.info("%s - Parsing keypoint annotations for category '%s'" %
+                                (image.external_id, rule.category))
+                    all_annotations += matches
+
+            for annotation_match_idx, annotation_match in enumerate(all_annotations):
+                file_name = external_id
+                if separate_by_annotation:
+                    file_name = get_separated_file_name(file_name, annotation_idx)
+
+                if file_name not in coco_images:
+                    image_id += 1
+                    coco_images[file_name] = {
+                        'image': CocoImage(
+                            id=image_id,
+                            file_name=file_name,
+                            coco_url=os.path.join(os.path.split(image.url)[0], file_name),
+                            width=0,
+                            height=0),
+                        'source_url': image.url,
+                        'external_id': external_id,
+                        'annotations': {}}
+
+                if separate_by_annotation:
+                    annotation_idx += 1
+
+                external_annotation_id = image.external_id
+                if job_plan.has_annotation_id_pattern():
+                    external_annotation_id = job_plan.external_annotation_id(file_name, image.external_id)
+                elif separate_by_annotation:
+                    external_annotation_id = "%s - %s" % (file_name, annotation_match_idx)
+
+                if external_annotation_id not in coco_images[file_name]['annotations']:
                     if separate_by_annotation:
-                        annotation_idx += 1
-
-                    external_annotation_id = image.external_id
-                    if 'annotationIdPattern' in job_config:
-                        rexp = re.compile(job_config['annotationIdPattern'])
-                        external_annotation_id = "%s - %s" % (file_name,
-                                                              ''.join(re.split(rexp, image.external_id)))
-                    elif separate_by_annotation:
-                        external_annotation_id = "%s - %s" % (file_name, annotation_match_idx)
-
-                    if external_annotation_id not in coco_images[file_name]['annotations']:
-                        if separate_by_annotation:
-                            category_id = get_coco_category(annotation_match['category']).id
-                        else:
-                            category_id = get_coco_category(bbox_category).id
-
-                        coco_images[file_name]['annotations'][external_annotation_id] = CocoKeypointAnnotation(
-                            image_id=image_id, category_id=category_id)
-
-                    current_annotation = coco_images[file_name]['annotations'][external_annotation_id]
-                    if annotation_match['type'] == 'bbox':
-                        current_annotation.bbox = [
-                            annotation_match['annotation']['left'],
-                            annotation_match['annotation']['top'],
-                            annotation_match['annotation']['width'],
-                            annotation_match['annotation']['height']]
-                    elif annotation_match['type'] == 'keypoint':
-                        current_annotation.add_keypoint(
-                            CocoKeypointCategory.Keypoint(annotation_match['category']),
-                            annotation_match['annotation']['x'],
-                            annotation_match['annotation']['y'],
-                            CocoKeypointAnnotation.Visibility(annotation_match['visibility']))
-
-        annotation_id = 0
-        for external_id in coco_images:
-            self.coco.images.append(coco_images[external_id]['image'])
-            for external_annotation_id in coco_images[external_id]['annotations']:
-                coco_images[external_id]['annotations'][external_annotation_id].id = annotation_id
-                coco_images[external_id]['annotations'][external_annotation_id].compute_area()
-                coco_images[external_id]['annotations'][external_annotation_id].compute_num_keypoints()
-                self.coco.annotations.append(coco_images[external_id]['annotations'][external_annotation_id])
-                annotation_id += 1
+                        category_id = get_coco_category(annotation_match['category']).id
+                    else:
+                        category_id = get_coco_category(bbox_category).id
+
+                    coco_images[file_name]['annotations'][external_annotation_id] = CocoKeypointAnnotation(
+                        image_id=image_id, category_id=category_id)
+
+                current_annotation = coco_images[file_name]['annotations'][external_annotation_id]
+                if annotation_match['type'] == 'bbox':
+                    current_annotation.bbox = [
+                        annotation_match['annotation']['left'],
+                        annotation_match['annotation']['top'],
+                        annotation_match['annotation']['width'],
+                        annotation_match['annotation']['height']]
+                elif annotation_match['type'] == 'keypoint':
+                    current_annotation.add_keypoint(
+                        CocoKeypointCategory.Keypoint(annotation_match['category']),
+                        annotation_match['annotation']['x'],
+                        annotation_match['annotation']['y'],
+                        CocoKeypointAnnotation.Visibility(annotation_match['visibility']))
 
     def load_data_with_classifiers(self, image_urls):
         annotator = Annotate()
@@ -186,17 +288,21 @@ class CocoGenerator:
         for image_idx, image in enumerate(image_urls):
             logger.info("Downloading image %s" % (image.url))
             tic = time.time()
-            response = requests.get(image.url)
-            if not response.ok:
-                logger.warn("Failed downloading %s" % (image.url))
+            try:
+                image_bytes = fetch_image_bytes(image.url)
+            except Exception as e:
+                logger.warn("Failed downloading %s: %s" % (image.url, e))
                 continue
 
             logger.info('Done Downloading (t={:0.2f}s)'.format(time.time() - tic))
 
             with tempfile.NamedTemporaryFile() as temp_image:
-                temp_image.write(response.content)
+                temp_image.write(image_bytes)
                 temp_image.flush()
 
+                with PILImage.open(temp_image.name) as pil_image:
+                    width, height = pil_image.size
+
                 logger.info("Annotating image %s" % (image.url))
                 tic = time.time()
                 annotations = annotator.annotate_image(temp_image.name)
@@ -309,8 +415,8 @@ class CocoGenerator:
                         file_name=os.path.basename(
                             image.url),
                         coco_url=image.url,
-                        width=0,
-                        height=0))
+                        width=width,
+                        height=height))
                 self.coco.annotations.extend(coco_annotations)
 
                 logger.info('Done Annotating (t={:0.2f}s)'.format(time.time() - tic))
@@ -318,5 +424,8 @@ class CocoGenerator:
     def load_data_from_pycoco(self, pycoco):
         self.coco.load_pycoco(pycoco)
 
+    def load_data_from_coco_file(self, coco_file):
+        self.coco.load_file(coco_file, load_categories=False)
+
     def model(self):
         return self.coco
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import re
+
+from jsonpath_ng import Child, Fields, Root, This
+from jsonpath_ng.ext import parse
+from jsonpath_ng.ext.filter import Filter
+
+from .coco.models.annotation import KeypointAnnotation as CocoKeypointAnnotation
+
+
+class CocoAnnotationRule:
+    """Compiled form of a single entry in a job config's 'annotations' list"""
+
+    def __init__(self, annotation_config):
+        self.type = annotation_config['type']
+        self.category = annotation_config['category']
+
+        # List of (jsonpath expression, visibility) pairs, bbox rules have a single 'match'
+        # expression while keypoint rules have a 'visible' and a 'notVisible' expression
+        self.matchers = []
+        if self.type == 'bbox':
+            self.matchers.append((parse(annotation_config['match']), True))
+        elif self.type == 'keypoint':
+            self.matchers.append((parse(annotation_config['visible']),
+                                  CocoKeypointAnnotation.Visibility.VISIBILITY_LABELED_VISIBLE))
+            self.matchers.append((parse(annotation_config['notVisible']),
+                                  CocoKeypointAnnotation.Visibility.VISIBILITY_LABELED_NOT_VISIBLE))
+
+
+def _indexable_filter(jsonpath_expr):
+    """
+    Reduce a "$[?(@.type = '...' & @.label = '...')]" (or "@.label =~ '...'") jsonpath expression to its conditions
+
+    :return: Tuple of (type, label operator, label) or None if the expression can't be served from a (type, label) index
+    """
+    if not isinstance(jsonpath_expr, Child) or not isinstance(jsonpath_expr.left, Root) or \
+            not isinstance(jsonpath_expr.right, Filter):
+        return None
+
+    conditions = {}
+    for expression in jsonpath_expr.right.expressions:
+        target = expression.target
+        if isinstance(target, Child) and isinstance(target.left, This):
+            target = target.right
+
+        if not isinstance(target, Fields) or len(target.fields) != 1 or not isinstance(expression.value, str):
+            return None
+
+        field = target.fields[0]
+        if field in conditions:
+            return None
+        conditions[field] = (expression.op, expression.value)
+
+    if set(conditions.keys()) != {'type', 'label'}:
+        return None
+
+    if conditions['type'][0] not in ['=', '=='] or conditions['label'][0] not in ['=', '==', '=~']:
+        return None
+
+    return conditions['type'][1], conditions['label'][0], conditions['label'][1]
+
+
+class CocoAnnotationMatcher:
+    """
+    Routes an image's annotations to a list of jsonpath expressions in a single pass.
+
+    Expressions in the common "type equality + label equality/regex" shape are served from a (type, label) lookup,
+    anything else falls back to running the jsonpath expression over the image's annotations.
+    """
+
+    def __init__(self, jsonpath_exprs):
+        self.num_slots = len(jsonpath_exprs)
+
+        self._equal = {}
+        self._regex = {}
+        self._fallback = []
+        self._routes = {}
+
+        for slot, jsonpath_expr in enumerate(jsonpath_exprs):
+            conditions = _indexable_filter(jsonpath_expr)
+            if conditions is None:
+                self._fallback.append((slot, jsonpath_expr))
+                continue
+
+            annotation_type, label_op, label = conditions
+            if label_op == '=~':
+                self._regex.setdefault(annotation_type, []).append((slot, re.compile(label)))
+            else:
+                self._equal.setdefault((annotation_type, label), []).append(slot)
+
+    def routes(self, annotation_type, label):
+        key = (annotation_type, label)
+        if key not in self._routes:
+            slots = list(self._equal.get(key, []))
+            if isinstance(label, str):
+                for slot, regex in self._regex.get(annotation_type, []):
+                    if regex.search(label):
+                        slots.append(slot)
+            self._routes[key] = sorted(slots)
+
+        return self._routes[key]
+
+    def match(self, annotations):
+        """
+        :param annotations: list of platform Annotation models belonging to a single image
+        :return: list with an entry per expression, each entry a list of matched annotation dicts in annotation order
+        """
+        matches = [[] for _ in range(self.num_slots)]
+        for annotation in annotations:
+            slots = self.routes(annotation.type, getattr(annotation, 'label', None))
+            if len(slots) == 0:
+                continue
+
+            annotation_as_dict = annotation.dict()
+            for slot in slots:
+                matches[slot].append(annotation_as_dict)
+
+        if len(self._fallback) > 0:
+            annotations_as_dict = [annotation.dict() for annotation in annotations]
+            for slot, jsonpath_expr in self._fallback:
+                matches[slot] = [match.value for match in jsonpath_expr.find(annotations_as_dict)]
+
+        return matches
+
+
+class CocoJobPlan:
+    """
+    Compiled form of a single entry in a generate-coco config's 'jobs' list.
+
+    Compiles jsonpath expressions and id regexes once per job so the per-image loop only executes the plan.
+    """
+
+    def __init__(self, job_config):
+        self.name = job_config['name']
+
+        # Identifies the job's rule set, incremental runs regenerate a job's images when it changes
+        self.fingerprint = hashlib.sha256(json.dumps(job_config, sort_keys=True).encode('utf-8')).hexdigest()
+
+        self.external_id_pattern = None
+        if 'externalIdPattern' in job_config:
+            self.external_id_pattern = re.compile(job_config['externalIdPattern'])
+
+        self.annotation_id_pattern = None
+        if 'annotationIdPattern' in job_config:
+            self.annotation_id_pattern = re.compile(job_config['annotationIdPattern'])
+
+        self.rules = [CocoAnnotationRule(annotation_config) for annotation_config in job_config['annotations']]
+        self.matcher = CocoAnnotationMatcher(
+            [jsonpath_expr for rule in self.rules for jsonpath_expr, _ in rule.matchers])
+
+    def match(self, annotations):
+        """
+        :param annotations: list of platform Annotation models belonging to a single image
+        :return: list of (rule, matches) tuples in config order, matches are in the format consumed by CocoGenerator
+        """
+        slot_matches = iter(self.matcher.match(annotations))
+
+        results = []
+        for rule in self.rules:
+            matches = []
+            for _, visibility in rule.matchers:
+                for annotation in next(slot_matches):
+                    matches.append({
+                        'annotation': annotation,
+                        'type': rule.type,
+                        'category': rule.category,
+                        'visibility': visibility})
+            results.append((rule, matches))
+
+        return results
+
+    def normalize_external_id(self, external_id):
+        if self.external_id_pattern is None:
+            return external_id
+
+        return ''.join(self.external_id_pattern.split(external_id))
+
+    def has_annotation_id_pattern(self):
+        return self.annotation_id_pattern is not None
+
+    def external_annotation_id(self, file_name, external_id):
+        return "%s - %s" % (file_name, ''.join(self.annotation_id_pattern.split(external_id)))
+
+    def incomplete_image_ids(self, images):
+        return frozenset(self.normalize_external_id(image.external_id) for image in images)
+
+
+def compile_coco_config(config):
+    return [CocoJobPlan(job_config) for job_config in config['jobs']]
@@ -1,17 +1,27 @@
 from datetime import datetime
+from functools import partial
 import json
 import ndjson
 import pathlib
 import time
 import uuid
 
-from pycocotools.coco import COCO as py_coco
+import numpy as np
 
-from .aws.s3_util import upload_file_to_bucket
+from .aws.s3_util import S3MultipartWriter, create_presigned_url, upload_file_to_bucket
+from .coco.manifest import CocoManifest
+from .coco.models.category import all_coco_categories
+from .coco.models.coco import Coco
+from .coco.split import image_group_key
+from .coco.writer import CocoJsonWriter, CocoShardWriter, CocoSplitWriter, shard_file_name
 from .coco_generator import CocoGenerator
-from .draw import draw_annotations_and_save
+from .draw import MOSAIC_LABEL_HEIGHT, contact_sheet, crop_annotations, crop_draft_scale, decode_image, \
+    draw_annotations, encode_image, image_file_name, image_save_args, render_tile
 from .helper import *
+from .image_cache import fetch_image_bytes
 from .log import logger
+from .pipeline import Pipeline, Stage
+from .platforms.models.annotation import BoundingBoxAnnotation
 
 
 def fetch_jobs(status='Completed', platform='labelbox', limit=None):
@@ -32,10 +42,30 @@ def fetch_annotations(job_name, platform='labelbox', consolidate=True):
 def generate_image_set(job_name='', platform='labelbox', output=os.getcwd(),
                        mode='combine', consolidate=True, naked=False,
                        filter_min_confidence=0.0, filter_min_labelers=3,
-                       append_job_name=''):
-    valid_modes = ['combine', 'separate']
+                       append_job_name='', max_workers=8, max_pending=None,
+                       image_format='png', quality=None, compress_level=None, encode_workers=None,
+                       crop_padding=0.1, crop_size=None, mosaic_grid=(8, 8), mosaic_tile_size=(320, 200)):
+    """
+    :param max_workers: number of images downloaded, and number of outputs rendered, concurrently
+    :param max_pending: maximum number of items waiting in each stage's queue (downloaded images, decoded images,
+                        rendered outputs, ...), defaults to twice the stage's number of workers
+    :param image_format: png|jpeg|webp, output files get the format's extension
+    :param quality: JPEG/WebP quality (1-100)
+    :param compress_level: PNG compression level (0-9)
+    :param encode_workers: number of processes encoding images, defaults to the number of CPUs (when there's
+                           more than one), 0 encodes on threads
+    :param crop_padding: 'crop' mode, margin added around each bounding box as a fraction of its width/height
+    :param crop_size: 'crop' mode, optional (width, height) every crop is resized to. Source JPEGs are decoded
+                      at a reduced resolution when all of an image's crops are smaller than their region
+    :param mosaic_grid: 'mosaic' mode, (columns, rows) of images on each contact sheet
+    :param mosaic_tile_size: 'mosaic' mode, (width, height) of each image's tile, including its label.
+                             Source JPEGs are decoded at a reduced resolution close to the tile's size
+    """
+    valid_modes = ['combine', 'separate', 'crop', 'mosaic']
     if mode.lower() not in valid_modes:
-        raise Exception("'%s' invalid mode, must be combine|separate")
+        raise Exception("'%s' invalid mode, must be combine|separate|crop|mosaic" % mode)
+    if mode == 'mosaic' and mosaic_tile_size[1] <= MOSAIC_LABEL_HEIGHT:
+        raise Exception("Mosaic tiles must be taller than their %dpx label" % MOSAIC_LABEL_HEIGHT)
 
     active_platform = get_platform(platform)
     annotations, _ = active_platform.fetch_annotations(
@@ -54,25 +84,127 @@ def generate_image_set(job_name='', platform='labelbox', output=os.getcwd(),
 
     pathlib.Path(instance_output_path).mkdir(parents=True, exist_ok=True)
 
+    # (image url, [(annotations to draw, output file name, crop box), ...]), each source image is fetched once
+    # and all of its outputs are rendered from that one decoded image
+    render_tasks = []
     for image in annotations.images:
         image_name = os.path.basename(image.url)
-        if mode == 'combine':
+        if mode == 'combine' or mode == 'mosaic':
             image_annotations = image.annotations if not naked else []
-            if image_name in existing_image_names:
+            output_name = image_file_name(image_name, image_format)
+            if image_name in existing_image_names or output_name in existing_image_names:
                 logger.info("Skipping '%s', image already in the 'append' dataset" % image_name)
                 continue
 
-            draw_annotations_and_save(image.url, image_annotations, instance_output_path, image_name)
-        elif mode == 'separate':
+            # Mosaic tiles are labeled with the source image's name
+            render_tasks.append((image.url, [(image_annotations, output_name if mode == 'combine' else image_name,
+                                              None)]))
+        elif mode == 'separate' or mode == 'crop':
+            outputs = []
             for idx, annotation in enumerate(image.annotations):
+                crop_box = None
+                if mode == 'crop':
+                    # Only bounding boxes have a region to crop, indexes still match 'separate' mode's file names
+                    if not isinstance(annotation, BoundingBoxAnnotation):
+                        continue
+                    crop_box = [annotation.left, annotation.top, annotation.width, annotation.height]
+
                 image_annotation = [annotation] if not naked else []
                 separated_file_name = get_separated_file_name(image_name, idx)
-                if separated_file_name in existing_image_names:
+                output_name = image_file_name(separated_file_name, image_format)
+                if separated_file_name in existing_image_names or output_name in existing_image_names:
                     logger.info("Skipping '%s', image already in the 'append' dataset" % separated_file_name)
                     continue
 
-                draw_annotations_and_save(
-                    image.url, image_annotation, instance_output_path, separated_file_name)
+                outputs.append((image_annotation, output_name, crop_box))
+
+            if len(outputs) > 0:
+                render_tasks.append((image.url, outputs))
+
+    save_args = image_save_args(image_format, quality=quality, compress_level=compress_level)
+    if encode_workers is None:
+        # A single encoder process would only add IPC overhead on a single CPU
+        encode_workers = os.cpu_count() if (os.cpu_count() or 1) > 1 else 0
+    num_cpus = os.cpu_count() or 1
+
+    # Crops are cut from images decoded at the smallest scale any of the image's crops needs
+    draft_scales = {}
+    if mode == 'crop':
+        for image_url, outputs in render_tasks:
+            draft_scales[image_url] = crop_draft_scale(
+                [crop_box for _, _, crop_box in outputs], padding=crop_padding, output_size=crop_size)
+
+    def download(task):
+        idx, (image_url, outputs) = task
+        return idx, image_url, outputs, fetch_image_bytes(image_url)
+
+    def decode(item):
+        idx, image_url, outputs, data = item
+        img_pil, scale = decode_image(data, draft_scale=draft_scales.get(image_url),
+                                      draft_size=mosaic_tile_size if mode == 'mosaic' else None)
+        return idx, outputs, img_pil, scale
+
+    def draw(item):
+        """Yields (output file name or tile index, image array, log description) per output"""
+        idx, outputs, img_pil, scale = item
+        for image_annotations, file_name, crop_box in outputs:
+            description = "%d annotations" % len(image_annotations)
+            if mode == 'mosaic':
+                yield idx, render_tile(img_pil, image_annotations, mosaic_tile_size, scale=scale, label=file_name), \
+                    description
+            elif crop_box is not None:
+                yield file_name, np.asarray(crop_annotations(
+                    img_pil, crop_box, image_annotations, padding=crop_padding, output_size=crop_size,
+                    scale=scale)), description
+            else:
+                yield file_name, np.asarray(draw_annotations(img_pil, image_annotations)), description
+
+    # Mosaic tiles arrive out of order, each sheet is laid out once all of its tiles are drawn
+    tiles_per_sheet = mosaic_grid[0] * mosaic_grid[1]
+    sheet_tiles = {}
+
+    def collect_tiles(item):
+        tile_idx, tile, _ = item
+        sheet_idx = tile_idx // tiles_per_sheet
+        sheet_tiles.setdefault(sheet_idx, {})[tile_idx] = tile
+        if len(sheet_tiles[sheet_idx]) < min(tiles_per_sheet, len(render_tasks) - sheet_idx * tiles_per_sheet):
+            return []
+
+        tiles = sheet_tiles.pop(sheet_idx)
+        return [(image_file_name("mosaic-%05d" % (sheet_idx + 1), image_format),
+                 contact_sheet([tiles[tile_idx] for tile_idx in sorted(tiles)], mosaic_grid[0]),
+                 "contact sheet of %d images" % len(tiles))]
+
+    def write(item):
+        file_name, data, description = item
+        with open("%s/%s" % (instance_output_path, file_name), 'wb') as f:
+            f.write(data)
+        logger.info("Saved image %s/%s (%s)" % (instance_output_path, file_name, description))
+
+    # Downloads, decoding, drawing, encoding and writing all overlap, the bounded queues between the stages
+    # keep the number of images in memory at any time proportional to the number of workers
+    stages = [
+        Stage('download', download, workers=max_workers, queue_size=max_pending),
+        Stage('decode', decode, workers=num_cpus, queue_size=max_pending),
+        Stage('draw', draw, workers=max_workers, fan_out=True, queue_size=max_pending)
+    ]
+    if mode == 'mosaic':
+        stages.append(Stage('sheet', collect_tiles, fan_out=True, queue_size=max_pending))
+    stages.extend([
+        Stage('encode', partial(_encode_output, save_args), workers=encode_workers or num_cpus,
+              processes=encode_workers > 0, queue_size=max_pending),
+        Stage('write', write, workers=2, queue_size=max_pending)
+    ])
+
+    pipeline = Pipeline(stages)
+    for _ in pipeline.run(enumerate(render_tasks)):
+        pass
+    pipeline.log_stats()
+
+
+def _encode_output(save_args, item):
+    file_name, image, description = item
+    return file_name, encode_image(image, save_args), description
 
 
 def generate_manifest(s3_images_uri, platform='labelbox', metadata=None):
@@ -82,32 +214,104 @@ def generate_manifest(s3_images_uri, platform='labelbox', metadata=None):
 
 def generate_coco_dataset(coco_generate_config, output=os.getcwd(), platform='labelbox', separate=False,
                           filter_min_confidence=0.0, filter_min_labelers=3,
-                          validation_set=0.0, coco_file_name=None, validation_file_name=None):
+                          validation_set=0.0, coco_file_name=None, validation_file_name=None, max_workers=4,
+                          gzip_output=False, validation_seed=None, validation_stratify=False,
+                          validation_group_pattern=None, probe_dimensions=False, probe_workers=16, shards=1,
+                          incremental_manifest=None):
     now = datetime.now()
     pathlib.Path(output).mkdir(parents=True, exist_ok=True)
 
+    def output_path(file_name):
+        if gzip_output and not file_name.endswith('.gz'):
+            file_name = "%s.gz" % file_name
+        return "%s/%s" % (output, file_name)
+
+    manifest = None
+    if incremental_manifest is not None:
+        manifest = CocoManifest(incremental_manifest)
+        logger.info("Loaded manifest %s with %d source images" % (incremental_manifest, len(manifest)))
+
     generator = CocoGenerator()
-    generator.load_data_from_platform(platform, coco_generate_config, separate,
-                                      filter_min_confidence=filter_min_confidence,
-                                      filter_min_labelers=filter_min_labelers)
-    model = generator.model()
+    load_args = {
+        'filter_min_confidence': filter_min_confidence,
+        'filter_min_labelers': filter_min_labelers,
+        'max_workers': max_workers,
+        'probe_dimensions': probe_dimensions,
+        'probe_workers': probe_workers,
+        'manifest': manifest
+    }
+
+    def coco_writer(file_name):
+        if shards <= 1:
+            return CocoJsonWriter(output_path(file_name), categories=all_coco_categories())
+
+        return CocoShardWriter([
+            CocoJsonWriter(output_path(shard_file_name(file_name, shard_idx, shards)), categories=all_coco_categories())
+            for shard_idx in range(shards)])
+
+    def output_files(writer):
+        if shards <= 1:
+            return [writer.file_path]
+        return [shard_writer.file_path for shard_writer in writer.shard_writers]
+
+    def log_saved(writer, description):
+        if shards <= 1:
+            logger.info("Saved %s to %s" % (description, writer.file_path))
+            return
+
+        base, _ = os.path.splitext(coco_file_name[:-3] if coco_file_name.endswith('.gz') else coco_file_name)
+        index_file = "%s/%s.shards.json" % (output, base)
+        with open(index_file, 'w') as f:
+            json.dump(writer.index(), f, indent=2)
+        logger.info("Saved %s as %d shards, shard index written to %s" % (description, shards, index_file))
 
-    output_file = "%s/%s" % (output, coco_file_name)
     if validation_set == 0.0:
-        with open(output_file, "w") as f:
-            f.write(model.json())
-        logger.info("Saved coco dataset to %s" % output_file)
+        with coco_writer(coco_file_name) as writer:
+            generator.load_data_from_platform(platform, coco_generate_config, separate, writer=writer, **load_args)
+        log_saved(writer, "coco dataset")
+        outputs = output_files(writer)
     else:
-        val_output_file = "%s/%s" % (output, validation_file_name)
-        [validation_model, train_model] = model.split(percent=validation_set)
+        val_output_file = output_path(validation_file_name)
+
+        group_key = None
+        if validation_group_pattern:
+            group_key = image_group_key(validation_group_pattern)
 
-        with open(output_file, "w") as f:
-            f.write(train_model.json())
-        logger.info("Saved coco training dataset to %s" % output_file)
+        # The split writer commits the training and validation outputs together, or neither of them
+        with CocoSplitWriter(CocoJsonWriter(val_output_file, categories=all_coco_categories()),
+                             coco_writer(coco_file_name), percent=validation_set, seed=validation_seed,
+                             stratify=validation_stratify, group_key=group_key) as split_writer:
+            generator.load_data_from_platform(platform, coco_generate_config, separate, writer=split_writer,
+                                              **load_args)
 
-        with open(val_output_file, "w") as f:
-            f.write(validation_model.json())
+        log_saved(split_writer.back_writer, "coco training dataset")
         logger.info("Saved coco validation dataset to %s" % val_output_file)
+        outputs = output_files(split_writer.back_writer) + [val_output_file]
+
+    if manifest is not None:
+        manifest.save(outputs)
+        logger.info("Saved manifest to %s" % incremental_manifest)
+
+
+def convert_coco_dataset(input_file, output_file):
+    """Convert a coco dataset between JSON (optionally gzipped) and the binary columnar .npz format"""
+    logger.info("Loading coco dataset %s..." % input_file)
+    tic = time.time()
+    coco = Coco()
+    coco.load_file(input_file)
+    logger.info('Done Loading coco dataset (t={:0.2f}s)'.format(time.time() - tic))
+
+    if output_file.endswith('.npz'):
+        coco.save_npz(output_file)
+    else:
+        with CocoJsonWriter(output_file, categories=coco.categories) as writer:
+            for image in coco.images:
+                writer.write_image(image)
+            for annotation in coco.annotations:
+                writer.write_annotation(annotation)
+
+    logger.info("Saved coco dataset with %d images and %d annotations to %s" % (
+        len(coco.images), len(coco.annotations), output_file))
 
 
 def create_dataset(dataset_name='', manifest_file=None):
@@ -131,6 +335,30 @@ def upload_coco_labels_to_job(job_name='', coco_annotation_file=None):
     platform.upload_coco_dataset(job_name, coco_annotation_file)
 
 
+def _load_mal_model(platform, job_name, coco_annotation_file=None):
+    generator = CocoGenerator()
+    if coco_annotation_file is not None:
+        generator.load_data_from_coco_file(coco_annotation_file)
+    else:
+        labelbox_image_urls = platform.fetch_images(job_name)
+        generator.load_data_with_classifiers(labelbox_image_urls)
+
+    return generator.model()
+
+
+def _mal_ndjson_upload_location():
+    """
+    :return: Tuple of (bucket name, new object name) to upload a MAL ndjson file to, or None if no bucket is set
+    """
+    bucket_name = os.environ.get('AWS_MAL_NDJSON_BUCKET', None)
+    if bucket_name is None:
+        logger.error("AWS_MAL_NDJSON_BUCKET required")
+        return None
+
+    upload_path = os.environ.get('AWS_MAL_NDJSON_PATH', '').lstrip("/")
+    return bucket_name, os.path.join(upload_path, '%s.ndjson' % (str(uuid.uuid4())))
+
+
 def generate_mal_ndjson(job_name='', output=os.getcwd(), coco_annotation_file=None, dataset_id=None):
     now = datetime.now()
     output_file = "%s/labelbox-mal-%s.ndjson" % (output, now.strftime("%m-%d-%YT%H:%M:%S"))
@@ -139,14 +367,7 @@ def generate_mal_ndjson(job_name='', output=os.getcwd(), coco_annotation_file=No
 
     platform = get_platform('labelbox')
 
-    generator = CocoGenerator()
-    if coco_annotation_file is not None:
-        generator.load_data_from_pycoco(py_coco(coco_annotation_file))
-    else:
-        labelbox_image_urls = platform.fetch_images(job_name)
-        generator.load_data_with_classifiers(labelbox_image_urls)
-
-    model = generator.model()
+    model = _load_mal_model(platform, job_name, coco_annotation_file)
     if len(model.annotations) == 0:
         logger.warn("No Machine Annotated Labels generated")
         return None
@@ -168,17 +389,13 @@ def generate_mal_ndjson(job_name='', output=os.getcwd(), coco_annotation_file=No
 
 
 def upload_mal_ndjson(job_name, mal_ndjson_file):
-    bucket_name = os.environ.get('AWS_MAL_NDJSON_BUCKET', None)
-    if bucket_name is None:
-        logger.error("AWS_MAL_NDJSON_BUCKET required")
+    upload_location = _mal_ndjson_upload_location()
+    if upload_location is None:
         return
-
-    upload_path = os.environ.get('AWS_MAL_NDJSON_PATH', '').lstrip("/")
+    bucket_name, object_name = upload_location
 
     platform = get_platform('labelbox')
 
-    object_name = os.path.join(upload_path, '%s.ndjson' % (str(uuid.uuid4())))
-
     # Upload ndjson_file and get URL
     mal_public_file_url = upload_file_to_bucket(
         mal_ndjson_file, bucket_name, object_name, meta_data={
@@ -192,6 +409,46 @@ def upload_mal_ndjson(job_name, mal_ndjson_file):
     return platform.create_mal_import_job(job_name, mal_public_file_url, deleteFeatures=False)
 
 
+def stream_mal_ndjson(job_name='', coco_annotation_file=None, dataset_id=None):
+    """
+    Generate MAL ndjson records and stream them straight to S3 as a multipart upload while they're generated,
+    then start the import job. Nothing is written to local disk and records are never all held in memory
+
+    :return: import job id, None if nothing was uploaded
+    """
+    upload_location = _mal_ndjson_upload_location()
+    if upload_location is None:
+        return
+    bucket_name, object_name = upload_location
+
+    platform = get_platform('labelbox')
+
+    model = _load_mal_model(platform, job_name, coco_annotation_file)
+    if len(model.annotations) == 0:
+        logger.warn("No Machine Annotated Labels generated")
+        return None
+
+    logger.info("Generating and uploading ndjson records to s3://%s/%s..." % (bucket_name, object_name))
+    tic = time.time()
+    client_filename = "labelbox-mal-%s.ndjson" % datetime.now().strftime("%m-%d-%YT%H:%M:%S")
+    num_records = 0
+    with S3MultipartWriter(bucket_name, object_name, meta_data={'client_filename': client_filename}) as f:
+        writer = ndjson.writer(f)
+        for record in platform.iter_mal_ndjson(job_name, model, filter_dataset_id=dataset_id):
+            writer.writerow(record)
+            num_records += 1
+    logger.info("Done uploading %d ndjson records, %d bytes (t=%0.2fs)" % (num_records, f.bytes_written,
+                                                                           time.time() - tic))
+
+    mal_public_file_url = create_presigned_url(bucket_name, object_name)
+    if mal_public_file_url is None:
+        logger.error("Failed to create a URL for the ndJSON file")
+        return
+    logger.info("Created ndJSON fileURL: %s" % mal_public_file_url)
+
+    return platform.create_mal_import_job(job_name, mal_public_file_url, deleteFeatures=False)
+
+
 def status_mal_ndjson(job_name, import_id):
     platform = get_platform('labelbox')
     return platform.get_status_mal_import_job(job_name, import_id)
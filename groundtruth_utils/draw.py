@@ -1,30 +1,231 @@
+import io
+import os
 from typing import Union
 
-import boto3
-from botocore.exceptions import ClientError
+import cv2 as cv
+import numpy as np
 from PIL import Image, ImageDraw
 
-from .aws.s3_util import download_fileobj_as_bytestream
-from .log import logger
-from .platforms.models.annotation import AnnotationTypes, BoundingBoxAnnotation, KeypointAnnotation
+from .image_cache import fetch_image_bytes
+from .platforms.models.annotation import BoundingBoxAnnotation, KeypointAnnotation
 
+BOX_FILL_COLOR = (0, 166, 156)
+BOX_FILL_ALPHA = 50 / 255
+BOX_OUTLINE_COLOR = (255, 255, 255)
+BOX_OUTLINE_WIDTH = 3
+KEYPOINT_COLOR = (65, 255, 126)
+KEYPOINT_FILL_ALPHA = 95 / 255
+KEYPOINT_RADIUS = 3
+SKELETON_COLOR = (255, 214, 0)
+SKELETON_WIDTH = 2
+
+MOSAIC_LABEL_HEIGHT = 18
+MOSAIC_LABEL_SCALE = 0.4
+MOSAIC_LABEL_COLOR = (255, 255, 255)
+
+# Output format -> (PIL format, file extension)
+IMAGE_FORMATS = {
+    'png': ('PNG', '.png'),
+    'jpeg': ('JPEG', '.jpg'),
+    'webp': ('WEBP', '.webp')
+}
+
+
+def get_s3_image_as_pil(image_uri, s3_client=None):
+    return get_s3_image_as_pil_scaled(image_uri, s3_client=s3_client)[0]
 
-def get_s3_image_as_pil(image_uri):
-    try:
-        s3_client = boto3.client('s3')
-        bytes_stream = download_fileobj_as_bytestream(s3_client, image_uri)
-    except ClientError as e:
-        print("Unexpected error fetching %s: %s" % (image_uri, e))
-        raise e
 
-    # Load image
+def get_s3_image_as_pil_scaled(image_uri, draft_scale=None, s3_client=None, draft_size=None):
+    """
+    :param draft_scale: see decode_image
+    :param draft_size: see decode_image
+    :return: Tuple of (PIL image, scale of the decoded image relative to the source image)
+    """
+    data = fetch_image_bytes(image_uri, s3_client=s3_client)
+    return decode_image(data, draft_scale=draft_scale, draft_size=draft_size)
+
+
+def decode_image(data, draft_scale=None, draft_size=None):
+    """
+    :param draft_scale: when below 1, JPEGs are decoded at the smallest reduced resolution (1/2, 1/4 or 1/8)
+                        that is at least draft_scale times the source's size. Other formats are decoded in full
+    :param draft_size: alternative to draft_scale, (width, height) the image will be downscaled to fit in
+    :return: Tuple of (RGB PIL image, scale of the decoded image relative to the source image)
+    """
+    bytes_stream = io.BytesIO(data)
     try:
-        bytes_stream.seek(0)
-        img_pil = Image.open(bytes_stream, 'r').convert('RGB')
+        img = Image.open(bytes_stream, 'r')
+        source_width = img.size[0]
+        if draft_size is not None:
+            draft_scale = min(draft_size[0] / img.size[0], draft_size[1] / img.size[1])
+        if draft_scale is not None and draft_scale < 1.0:
+            img.draft('RGB', (int(np.ceil(img.size[0] * draft_scale)), int(np.ceil(img.size[1] * draft_scale))))
+        img_pil = img.convert('RGB')
     finally:
         bytes_stream.close()
 
-    return img_pil
+    return img_pil, img_pil.size[0] / source_width
+
+
+def _blend_lut(color, alpha):
+    """
+    Blending a constant color is a per-channel lookup, far cheaper than float math over a 4K frame
+
+    :return: (256, 3) uint8 array of blended values per source value and channel
+    """
+    values = np.arange(256, dtype=np.float64)[:, None]
+    return np.round(values * (1.0 - alpha) + np.array(color, dtype=np.float64)[None, :] * alpha).astype(np.uint8)
+
+
+def _blend_mask(image, mask, color, alpha, regions):
+    """
+    Alpha blend a single color into image wherever mask is set. Each masked pixel is blended once however many
+    shapes in the layer overlap it, only the (N, 4) [x0, y0, x1, y1] regions covering the shapes are touched.
+    """
+    lut = _blend_lut(color, alpha).reshape((256, 1, 3))
+
+    height, width = mask.shape
+    regions = np.clip(regions, 0, [width, height, width, height])
+    for x0, y0, x1, y1 in regions.tolist():
+        if x1 <= x0 or y1 <= y0:
+            continue
+
+        roi = image[y0:y1, x0:x1]
+        roi_mask = mask[y0:y1, x0:x1]
+        cv.copyTo(cv.LUT(roi, lut), roi_mask, roi)
+        roi_mask[:] = 0
+
+
+def _blend_pixels(image, pixels, color, alpha):
+    """Alpha blend a single color into the (ys, xs) pixels of image, which must each appear once"""
+    ys, xs = pixels
+    image[ys, xs] = _blend_lut(color, alpha)[image[ys, xs], np.arange(3)]
+
+
+def _keypoint_masks():
+    """
+    Fill and outline masks of a keypoint marker, drawn with PIL once so markers look exactly like PIL's ellipses
+
+    :return: Tuple of ((D, D) fill mask, (D, D) outline mask), D = 2 * KEYPOINT_RADIUS + 1
+    """
+    size = 2 * KEYPOINT_RADIUS + 1
+    fill = Image.new('L', (size, size), 0)
+    ImageDraw.Draw(fill).ellipse([(0, 0), (size - 1, size - 1)], fill=255)
+    outline = Image.new('L', (size, size), 0)
+    ImageDraw.Draw(outline).ellipse([(0, 0), (size - 1, size - 1)], outline=255)
+    return np.array(fill), np.array(outline)
+
+
+KEYPOINT_FILL_MASK, KEYPOINT_OUTLINE_MASK = _keypoint_masks()
+# (P, 2) [dy, dx] offsets of the pixels set in each mask, relative to the marker's center
+KEYPOINT_FILL_OFFSETS = np.argwhere(KEYPOINT_FILL_MASK > 0) - KEYPOINT_RADIUS
+KEYPOINT_OUTLINE_OFFSETS = np.argwhere(KEYPOINT_OUTLINE_MASK > 0) - KEYPOINT_RADIUS
+
+
+def _stamp_pixels(shape, centers, offsets):
+    """
+    Pixels of a stamp, given as [dy, dx] offsets, placed on each of centers and clipped to an image of the given
+    shape
+
+    :return: Tuple of (ys, xs) index arrays, pixels covered by several stamps appear once
+    """
+    height, width = shape[:2]
+    ys = (centers[:, 1, None] + offsets[None, :, 0]).ravel()
+    xs = (centers[:, 0, None] + offsets[None, :, 1]).ravel()
+    inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+    # Sorting and dropping repeats is several times faster than np.unique on recent NumPy versions
+    pixels = np.sort(ys[inside].astype(np.int64) * width + xs[inside])
+    first = np.ones(len(pixels), dtype=bool)
+    first[1:] = pixels[1:] != pixels[:-1]
+    pixels = pixels[first]
+    return np.divmod(pixels, width)
+
+
+def render_annotations(image, boxes=None, points=None, skeleton=None, copy=True):
+    """
+    Draw boxes, keypoints and skeleton limbs onto an image array. Shape geometry is computed for all shapes at once
+    with NumPy, keypoint markers are drawn with a single indexing operation per layer
+
+    :param image: (H, W, 3) uint8 RGB array
+    :param boxes: (N, 4) array of [left, top, width, height]
+    :param points: (N, K, 2|3) array of per person [x, y(, visibility)] keypoints or a flat (M, 2|3) array of points.
+                   Points with a visibility of 0 (not labeled) aren't drawn
+    :param skeleton: list of 1-based [keypoint id, keypoint id] limb pairs, e.g.
+                     KeypointCategory.coco_17_person_skeleton(), drawn between each person's visible keypoints
+    :param copy: draw on a copy of image rather than in place
+    :return: (H, W, 3) uint8 RGB array
+    """
+    if copy:
+        image = image.copy()
+
+    boxes = np.asarray(boxes if boxes is not None else [], dtype=np.float64).reshape((-1, 4)).astype(np.int32)
+    if len(boxes) > 0:
+        left, top = boxes[:, 0], boxes[:, 1]
+        right, bottom = left + boxes[:, 2], top + boxes[:, 3]
+        # Outlines are drawn inside the box edges like PIL's, as filled strips so corners stay square
+        inset = BOX_OUTLINE_WIDTH - 1
+        strips = np.stack([
+            np.stack([left, top, right, top + inset], axis=1),
+            np.stack([left, bottom - inset, right, bottom], axis=1),
+            np.stack([left, top, left + inset, bottom], axis=1),
+            np.stack([right - inset, top, right, bottom], axis=1)], axis=1).reshape((-1, 4))
+
+        # Boxes may overlap, which one cv.fillPoly call can't rasterize (overlaps cancel out under its even-odd
+        # rule), so each rectangle is its own OpenCV call. The cost is in the pixels, not in these calls
+        mask = np.zeros(image.shape[:2], dtype=np.uint8)
+        fills = np.stack([left, top, right, bottom], axis=1)
+        for x0, y0, x1, y1 in fills.tolist():
+            cv.rectangle(mask, (x0, y0), (x1, y1), 255, -1)
+        _blend_mask(image, mask, BOX_FILL_COLOR, BOX_FILL_ALPHA,
+                    np.hstack([np.minimum(fills[:, :2], fills[:, 2:]), np.maximum(fills[:, :2], fills[:, 2:]) + 1]))
+
+        for x0, y0, x1, y1 in strips.tolist():
+            cv.rectangle(image, (x0, y0), (x1, y1), BOX_OUTLINE_COLOR, -1)
+
+    points = np.asarray(points if points is not None else [], dtype=np.float64)
+    if points.size > 0:
+        if points.ndim == 2:
+            points = points[:, None, :]
+            skeleton = None
+
+        visible = points[:, :, 2] > 0 if points.shape[2] > 2 else np.ones(points.shape[:2], dtype=bool)
+        coords = points[:, :, :2].astype(np.int32)
+
+        if skeleton:
+            limbs = np.asarray(skeleton, dtype=np.int64) - 1
+            limbs = limbs[(limbs < points.shape[1]).all(axis=1)]
+            limb_visible = visible[:, limbs[:, 0]] & visible[:, limbs[:, 1]]
+            segments = np.stack([coords[:, limbs[:, 0]], coords[:, limbs[:, 1]]], axis=2)[limb_visible]
+            if len(segments) > 0:
+                cv.polylines(image, list(segments), False, SKELETON_COLOR, SKELETON_WIDTH, cv.LINE_AA)
+
+        centers = coords[visible]
+        _blend_pixels(image, _stamp_pixels(image.shape, centers, KEYPOINT_FILL_OFFSETS), KEYPOINT_COLOR,
+                      KEYPOINT_FILL_ALPHA)
+        image[_stamp_pixels(image.shape, centers, KEYPOINT_OUTLINE_OFFSETS)] = KEYPOINT_COLOR
+
+    return image
+
+
+def annotations_to_arrays(annotations):
+    """
+    Collect platform BoundingBox/Keypoint annotations and annotate.Annotate results ({'bbox', 'keypoints'} dicts)
+    into the box and point arrays consumed by render_annotations
+
+    :return: Tuple of ((N, 4) boxes array, (M, 2) points array)
+    """
+    boxes = []
+    points = []
+    for annotation in annotations:
+        if isinstance(annotation, BoundingBoxAnnotation):
+            boxes.append([annotation.left, annotation.top, annotation.width, annotation.height])
+        elif isinstance(annotation, KeypointAnnotation):
+            points.append([annotation.x, annotation.y])
+        elif isinstance(annotation, dict) and 'bbox' in annotation and 'keypoints' in annotation:
+            boxes.append([float(coord) for coord in annotation['bbox'][:4]])
+            points.extend([float(keypoint[0]), float(keypoint[1])] for keypoint in annotation['keypoints'])
+
+    return np.array(boxes, dtype=np.float64).reshape((-1, 4)), np.array(points, dtype=np.float64).reshape((-1, 2))
 
 
 def draw_annotations(image: Union[str, Image.Image], annotations):
@@ -33,55 +234,180 @@ def draw_annotations(image: Union[str, Image.Image], annotations):
     else:
         img_pil = get_s3_image_as_pil(image)
 
-    img_draw = ImageDraw.Draw(img_pil, 'RGBA')
+    boxes, points = annotations_to_arrays(annotations)
+    if len(boxes) == 0 and len(points) == 0:
+        return img_pil
+
+    if img_pil.mode != 'RGB':
+        img_pil = img_pil.convert('RGB')
+    img = render_annotations(np.array(img_pil), boxes=boxes, points=points, copy=False)
+    return Image.fromarray(img)
+
+
+def crop_region(box, padding=0.1, output_size=None):
+    """
+    Region cropped around a box, grown to the output size's aspect ratio so resizing it doesn't distort the image
+
+    :param box: [left, top, width, height]
+    :param padding: margin added on each side, as a fraction of the box's width/height
+    :param output_size: optional (width, height) the crop is resized to
+    :return: [x0, y0, x1, y1] region, may extend past the image's edges
+    """
+    left, top, width, height = [float(coord) for coord in box[:4]]
+    width, height = max(width, 1.0), max(height, 1.0)
+    x0, x1 = left - width * padding, left + width * (1.0 + padding)
+    y0, y1 = top - height * padding, top + height * (1.0 + padding)
+
+    if output_size is not None:
+        aspect = output_size[0] / output_size[1]
+        if (x1 - x0) / (y1 - y0) < aspect:
+            grow = ((y1 - y0) * aspect - (x1 - x0)) / 2
+            x0, x1 = x0 - grow, x1 + grow
+        else:
+            grow = ((x1 - x0) / aspect - (y1 - y0)) / 2
+            y0, y1 = y0 - grow, y1 + grow
+
+    return [x0, y0, x1, y1]
+
+
+def crop_draft_scale(boxes, padding=0.1, output_size=None):
+    """
+    Smallest decode scale that still gives every box's crop at least output_size pixels, 1.0 without an output size
+    """
+    if output_size is None or len(boxes) == 0:
+        return 1.0
+
+    scale = 0.0
+    for box in boxes:
+        x0, y0, x1, y1 = crop_region(box, padding=padding, output_size=output_size)
+        scale = max(scale, output_size[0] / (x1 - x0), output_size[1] / (y1 - y0))
+
+    return min(1.0, scale)
+
+
+def crop_annotations(image: Image.Image, box, annotations, padding=0.1, output_size=None, scale=1.0):
+    """
+    Crop the region around a box and draw annotations on the crop
+
+    :param box: [left, top, width, height] in source image pixels
+    :param output_size: optional (width, height) the crop is resized to
+    :param scale: size of image relative to the source image, e.g. get_s3_image_as_pil_scaled's scale
+    :return: PIL image, parts of the region outside the image are black
+    """
+    x0, y0, x1, y1 = [int(round(coord * scale)) for coord in crop_region(box, padding, output_size)]
+    img_crop = image.crop((x0, y0, max(x1, x0 + 1), max(y1, y0 + 1)))
+    resize_x, resize_y = 1.0, 1.0
+    if output_size is not None:
+        resize_x, resize_y = output_size[0] / img_crop.width, output_size[1] / img_crop.height
+        img_crop = img_crop.resize(tuple(output_size), Image.BILINEAR)
+
+    boxes, points = annotations_to_arrays(annotations)
+    if len(boxes) == 0 and len(points) == 0:
+        return img_crop
+
+    boxes = (boxes * scale - [x0, y0, 0, 0]) * [resize_x, resize_y, resize_x, resize_y]
+    points = (points * scale - [x0, y0]) * [resize_x, resize_y]
+    if img_crop.mode != 'RGB':
+        img_crop = img_crop.convert('RGB')
+    img = render_annotations(np.array(img_crop), boxes=boxes, points=points, copy=False)
+    return Image.fromarray(img)
+
+
+def _fit_label(label, width):
+    """Trim a label from the left until it fits in width pixels, file names differ most at their end"""
+    trimmed = label
+    while len(trimmed) > 0 and cv.getTextSize(
+            trimmed, cv.FONT_HERSHEY_SIMPLEX, MOSAIC_LABEL_SCALE, 1)[0][0] > width:
+        label = label[1:]
+        trimmed = "..%s" % label
+
+    return trimmed
+
+
+def render_tile(image: Image.Image, annotations, tile_size, scale=1.0, label=None):
+    """
+    Downscale an image to fit a contact sheet tile, draw its annotations and label it
+
+    :param tile_size: (width, height) of the tile, the label is drawn in a strip at the bottom
+    :param scale: size of image relative to the source image, e.g. get_s3_image_as_pil_scaled's scale
+    :return: (height, width, 3) uint8 RGB array, the image is centered on a black background
+    """
+    tile_width, tile_height = tile_size
+    label_height = MOSAIC_LABEL_HEIGHT if label else 0
+    fit = min(tile_width / image.width, (tile_height - label_height) / image.height)
+    size = (max(1, int(round(image.width * fit))), max(1, int(round(image.height * fit))))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    img = np.array(image.resize(size, Image.BILINEAR))
+
+    boxes, points = annotations_to_arrays(annotations)
+    if len(boxes) > 0 or len(points) > 0:
+        img = render_annotations(img, boxes=boxes * scale * fit, points=points * scale * fit, copy=False)
+
+    tile = np.zeros((tile_height, tile_width, 3), dtype=np.uint8)
+    x0 = (tile_width - size[0]) // 2
+    y0 = (tile_height - label_height - size[1]) // 2
+    tile[y0:y0 + size[1], x0:x0 + size[0]] = img
+    if label:
+        cv.putText(tile, _fit_label(label, tile_width - 8), (4, tile_height - 6), cv.FONT_HERSHEY_SIMPLEX,
+                   MOSAIC_LABEL_SCALE, MOSAIC_LABEL_COLOR, 1, cv.LINE_AA)
+
+    return tile
+
+
+def contact_sheet(tiles, columns):
+    """
+    Lay tiles out in a grid, row by row. A partial last row is padded with black tiles
+
+    :param tiles: list of (height, width, 3) arrays, all the same size
+    :return: (rows * height, columns * width, 3) uint8 RGB array
+    """
+    tile_height, tile_width = tiles[0].shape[:2]
+    rows = int(np.ceil(len(tiles) / columns))
+    sheet = np.zeros((rows * tile_height, columns * tile_width, 3), dtype=np.uint8)
+    for idx, tile in enumerate(tiles):
+        row, column = divmod(idx, columns)
+        sheet[row * tile_height:(row + 1) * tile_height, column * tile_width:(column + 1) * tile_width] = tile
+
+    return sheet
+
+
+def image_file_name(image_name, image_format='png'):
+    """Swap image_name's extension for the output format's, e.g. frame.jpg -> frame.png"""
+    return "%s%s" % (os.path.splitext(image_name)[0], IMAGE_FORMATS[image_format][1])
+
+
+def image_save_args(image_format='png', quality=None, compress_level=None):
+    """
+    :param quality: JPEG/WebP quality (1-100), defaults to PIL's
+    :param compress_level: PNG zlib compression level (0-9), lower levels encode much faster. Defaults to PIL's
+    :return: kwargs for PIL's Image.save
+    """
+    save_args = {'format': IMAGE_FORMATS[image_format][0]}
+    if quality is not None and image_format in ['jpeg', 'webp']:
+        save_args['quality'] = quality
+    if compress_level is not None and image_format == 'png':
+        save_args['compress_level'] = compress_level
+
+    return save_args
+
+
+def save_image(image, path, save_args):
+    """Encode and write an image, image may be an (H, W, 3) RGB array so it can be handed to a process pool"""
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    image.save(path, **save_args)
+
+
+def encode_image(image, save_args):
+    """
+    :param image: PIL image or (H, W, 3) RGB array
+    :param save_args: see image_save_args
+    :return: encoded image bytes
+    """
+    bytes_stream = io.BytesIO()
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    image.save(bytes_stream, **save_args)
+    return bytes_stream.getvalue()
 
-    # Load boxes
-    for annotation in annotations:
-        if isinstance(annotation, BoundingBoxAnnotation) or isinstance(annotation, KeypointAnnotation):
-            draw_shape_on_image(img_draw, annotation)
-
-        if isinstance(annotation, dict) and 'bbox' in annotation and 'keypoints' in annotation:
-            for ii, (type, coords) in enumerate(annotation.items()):
-                if type == 'bbox':
-                    draw_shape_on_image(img_draw, BoundingBoxAnnotation(
-                        id='bbox',
-                        label='bbox',
-                        type=AnnotationTypes.TYPE_BOUNDING_BOX,
-                        left=float(coords[0]),
-                        top=float(coords[1]),
-                        width=float(coords[2]),
-                        height=float(coords[3]),
-                        raw_annotation=annotation
-                    ))
-                elif type == 'keypoints':
-                    for keypoint in coords:
-                        draw_shape_on_image(img_draw, KeypointAnnotation(
-                            id='keypoint',
-                            label='bbox',
-                            type=AnnotationTypes.TYPE_KEYPOINT,
-                            x=float(keypoint[0]),
-                            y=float(keypoint[1]),
-                            raw_annotation=annotation
-                        ))
-
-    return img_pil
-
-
-def draw_annotations_and_save(image_uri, annotations, output_path, image_name):
-    img_draw = draw_annotations(image_uri, annotations)
-    img_draw.save("%s/%s" % (output_path, image_name), "PNG")
-    logger.info("Saved image %s/%s (%d annotations)" % (output_path, image_name, len(annotations)))
-
-
-def draw_shape_on_image(img_draw, annotation):
-    if annotation.type == AnnotationTypes.TYPE_BOUNDING_BOX:
-        img_draw.rectangle([
-            (int(annotation.left), int(annotation.top)),
-            (int(annotation.left) + int(annotation.width), int(annotation.top) + int(annotation.height))
-        ], fill=(0, 166, 156, 50), outline=(255, 255, 255), width=3)
-    elif annotation.type == AnnotationTypes.TYPE_KEYPOINT:
-        radius = 3
-        img_draw.ellipse([
-            (int(annotation.x) - radius, int(annotation.y) - radius),
-            (int(annotation.x) + radius, int(annotation.y) + radius)
-        ], fill=(65, 255, 126, 95), outline=(65, 255, 126))
@@ -0,0 +1,173 @@
+import os
+import random
+import threading
+import time
+
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+import requests
+from requests.adapters import HTTPAdapter
+
+from .aws.client import get_client
+from .aws.s3_util import is_s3_uri, split_s3_bucket_key
+from .log import logger
+
+# Connections kept open per host (HTTP) and in the S3 client's pool, shared by every thread fetching images
+IMAGE_FETCH_MAX_CONNECTIONS = int(os.getenv('WF_GROUNDTRUTH_FETCH_MAX_CONNECTIONS', 64))
+IMAGE_FETCH_RETRIES = int(os.getenv('WF_GROUNDTRUTH_FETCH_RETRIES', 4))
+
+# HTTP statuses and S3 error codes worth retrying
+RETRY_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+RETRY_ERROR_CODES = ['RequestTimeout', 'SlowDown', 'Throttling', 'ThrottlingException', 'InternalError',
+                     'ServiceUnavailable', '500', '502', '503', '504']
+
+# Per-thread read buffers larger than this aren't kept for reuse
+MAX_REUSED_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+class ImageFetcher(object):
+    """
+    Fetches images from s3:// URIs, virtual-hosted S3 URLs (https://$BUCKET.s3.amazonaws.com/...) and any other
+    HTTP(S) URL. Keep-alive connections are pooled and shared by every thread, requests time out, and connection
+    errors, throttling and 5xx responses are retried with exponential backoff. Bodies are streamed into a per
+    thread buffer that's reused from one image to the next.
+    """
+
+    def __init__(self, max_connections=IMAGE_FETCH_MAX_CONNECTIONS, retries=IMAGE_FETCH_RETRIES, backoff=0.25,
+                 connect_timeout=10, read_timeout=60, chunk_size=256 * 1024):
+        """
+        :param retries: attempts after the first one before giving up
+        :param backoff: seconds waited before the first retry, doubled (with jitter) after each attempt
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = (connect_timeout, read_timeout)
+        self.chunk_size = chunk_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # Retries are handled here, for both backends the same way, rather than multiplied with botocore's
+        self._s3_config = Config(max_pool_connections=max_connections, connect_timeout=connect_timeout,
+                                 read_timeout=read_timeout, retries={'mode': 'standard', 'max_attempts': 0})
+        self._local = threading.local()
+
+    @property
+    def s3_client(self):
+        return get_client('s3', config=self._s3_config)
+
+    def _read_body(self, chunks, content_length=None, limit=None):
+        """
+        Copy streamed chunks into this thread's reusable buffer, growing it as needed
+
+        :param limit: stop reading once this many bytes were read, e.g. when a server ignored a Range header
+        """
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) < (content_length or 0):
+            buffer = bytearray(max(content_length or 0, self.chunk_size))
+
+        size = 0
+        for chunk in chunks:
+            if limit is not None and size >= limit:
+                break
+            if size + len(chunk) > len(buffer):
+                grown = bytearray(max(size + len(chunk), len(buffer) * 2))
+                with memoryview(buffer) as view:
+                    grown[:size] = view[:size]
+                buffer = grown
+            buffer[size:size + len(chunk)] = chunk
+            size += len(chunk)
+
+        self._local.buffer = buffer if len(buffer) <= MAX_REUSED_BUFFER_SIZE else None
+        # Slicing the bytearray itself would copy the body once more before bytes() does
+        with memoryview(buffer) as view:
+            return bytes(view[:size if limit is None else min(size, limit)])
+
+    def _fetch_s3(self, url, etag, last_modified, byte_range, s3_client):
+        bucket_name, key_name = split_s3_bucket_key(url.split('?')[0])
+        args = {}
+        if etag:
+            args['IfNoneMatch'] = etag
+        if byte_range is not None:
+            args['Range'] = "bytes=%d-%d" % byte_range
+
+        try:
+            response = (s3_client or self.s3_client).get_object(Bucket=bucket_name, Key=key_name, **args)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ['304', 'NotModified']:
+                return None, etag, last_modified
+            raise e
+
+        body = response['Body']
+        try:
+            data = self._read_body(iter(lambda: body.read(self.chunk_size), b''), response.get('ContentLength'),
+                                   limit=byte_range[1] - byte_range[0] + 1 if byte_range is not None else None)
+        finally:
+            body.close()
+
+        return data, response.get('ETag'), str(response.get('LastModified'))
+
+    def _fetch_http(self, url, etag, last_modified, byte_range):
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        if byte_range is not None:
+            headers['Range'] = "bytes=%d-%d" % byte_range
+
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304:
+                return None, etag, last_modified
+
+            response.raise_for_status()
+            content_length = response.headers.get('Content-Length')
+            data = self._read_body(response.iter_content(self.chunk_size),
+                                   int(content_length) if content_length and content_length.isdigit() else None,
+                                   limit=byte_range[1] - byte_range[0] + 1 if byte_range is not None else None)
+            return data, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+    @staticmethod
+    def is_retryable(error):
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code in RETRY_STATUS_CODES
+        if isinstance(error, ClientError):
+            return str(error.response.get('Error', {}).get('Code')) in RETRY_ERROR_CODES
+        # Connection errors, timeouts and bodies cut short
+        return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                                  requests.exceptions.ChunkedEncodingError, BotoCoreError))
+
+    def fetch(self, url, etag=None, last_modified=None, byte_range=None, s3_client=None):
+        """
+        GET an image, optionally conditional on the given validators or limited to a byte range
+
+        :param byte_range: optional (start, end) inclusive byte offsets, the result is shorter if the image is
+        :param s3_client: optional client to use instead of the fetcher's own
+        :return: Tuple of (body, etag, last_modified), body is None when the image wasn't modified
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                if is_s3_uri(url):
+                    return self._fetch_s3(url, etag, last_modified, byte_range, s3_client)
+                return self._fetch_http(url, etag, last_modified, byte_range)
+            except Exception as e:
+                if attempt >= self.retries or not self.__class__.is_retryable(e):
+                    raise e
+
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning("Failed fetching %s (attempt %d), retrying in %.2fs: %s" % (url, attempt + 1, delay, e))
+                time.sleep(delay)
+
+
+_default_image_fetcher = None
+_default_image_fetcher_lock = threading.Lock()
+
+
+def default_image_fetcher():
+    global _default_image_fetcher
+    with _default_image_fetcher_lock:
+        if _default_image_fetcher is None:
+            _default_image_fetcher = ImageFetcher()
+        return _default_image_fetcher
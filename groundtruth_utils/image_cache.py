@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import unquote
+
+from .base import data_dir
+from .fetcher import default_image_fetcher
+from .log import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows, eviction falls back to best effort without a cross-process lock
+    fcntl = None
+
+# Total size of cached image data, WF_GROUNDTRUTH_IMAGE_CACHE_SIZE=0 disables the cache
+IMAGE_CACHE_MAX_SIZE = int(os.getenv('WF_GROUNDTRUTH_IMAGE_CACHE_SIZE', 10 * 1024 ** 3))
+# Seconds a cached image is served without checking its ETag/Last-Modified with the source
+IMAGE_CACHE_MAX_AGE = int(os.getenv('WF_GROUNDTRUTH_IMAGE_CACHE_MAX_AGE', 24 * 60 * 60))
+# Query parameters that presign a URL (SigV2 and SigV4 'X-Amz-*') rather than identify the image
+PRESIGNED_URL_PARAMS = ['AWSAccessKeyId', 'Expires', 'Signature']
+PRESIGNED_URL_PARAM_PREFIX = 'x-amz-'
+
+
+def image_cache_dir():
+    return os.path.join(data_dir(), 'image_cache')
+
+
+def is_presigned_url_param(name):
+    return name in PRESIGNED_URL_PARAMS or name.lower().startswith(PRESIGNED_URL_PARAM_PREFIX)
+
+
+def cache_key_url(url):
+    """
+    url without its presigning query parameters, so every presigned URL of an image maps to the same cache
+    entry while URLs whose other query parameters differ don't
+    """
+    if '?' not in url:
+        return url
+
+    base, query = url.split('?', 1)
+    params = [param for param in query.split('&')
+              if param and not is_presigned_url_param(unquote(param.split('=', 1)[0]))]
+    return "%s?%s" % (base, '&'.join(params)) if len(params) > 0 else base
+
+
+class ImageCache(object):
+    """
+    Content-addressed on-disk image cache under data_dir(), shared by every process using the same data dir.
+
+    Image data is stored once per content hash in 'blobs/', each URL (presigning parameters dropped) has a small entry
+    in 'urls/' recording its blob and the ETag/Last-Modified it was fetched with. Entries older than max_age are
+    revalidated with a conditional GET. All files are written atomically, blobs are evicted least recently used
+    first once their total size exceeds max_size.
+    """
+
+    def __init__(self, directory=None, max_size=IMAGE_CACHE_MAX_SIZE, max_age=IMAGE_CACHE_MAX_AGE, fetcher=None):
+        """
+        :param fetcher: ImageFetcher images are fetched with, defaults to the shared fetcher
+        """
+        self.directory = directory or image_cache_dir()
+        self.max_size = max_size
+        self.max_age = max_age
+        self.fetcher = fetcher or default_image_fetcher()
+
+        self._lock = threading.Lock()
+        self._bytes_since_eviction = 0
+
+        os.makedirs(os.path.join(self.directory, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(self.directory, 'urls'), exist_ok=True)
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(cache_key_url(url).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, url):
+        return os.path.join(self.directory, 'urls', "%s.json" % self.__class__.key(url))
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], digest)
+
+    def _write_atomic(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def _read_entry(self, url):
+        try:
+            with open(self._entry_path(url), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_entry(self, url, entry):
+        self._write_atomic(self._entry_path(url), json.dumps(entry).encode('utf-8'))
+
+    def _read_blob(self, digest):
+        path = self._blob_path(digest)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Access time drives LRU eviction, atime is often disabled so mtime is bumped instead
+            os.utime(path)
+            return data
+        except OSError:
+            # Evicted, possibly by another process
+            return None
+
+    def cached_path(self, url):
+        """Path of the cached image for url without revalidating it, None if it isn't cached"""
+        entry = self._read_entry(url)
+        if entry is None:
+            return None
+
+        path = self._blob_path(entry['blob'])
+        return path if os.path.exists(path) else None
+
+    def store(self, url, data, etag=None, last_modified=None):
+        digest = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self._blob_path(digest)):
+            self._write_atomic(self._blob_path(digest), data)
+
+        self._write_entry(url, {
+            'url': cache_key_url(url),
+            'blob': digest,
+            'etag': etag,
+            'last_modified': last_modified,
+            'validated': time.time()
+        })
+
+        with self._lock:
+            self._bytes_since_eviction += len(data)
+            # Scanning the cache is linear in its size, only do it after a meaningful amount of new data
+            should_evict = self._bytes_since_eviction > self.max_size / 20
+            if should_evict:
+                self._bytes_since_eviction = 0
+
+        if should_evict:
+            self.evict()
+
+    def fetch(self, url, s3_client=None):
+        """
+        :return: the image's bytes, from the cache when the cached copy is fresh or still matches the source
+        """
+        if self.max_size <= 0:
+            return self.fetcher.fetch(url, s3_client=s3_client)[0]
+
+        entry = self._read_entry(url)
+        data = self._read_blob(entry['blob']) if entry is not None else None
+        if data is not None and time.time() - entry['validated'] < self.max_age:
+            return data
+
+        if data is None:
+            entry = {}
+
+        body, etag, last_modified = self.fetcher.fetch(
+            url, etag=entry.get('etag'), last_modified=entry.get('last_modified'), s3_client=s3_client)
+        if body is None:
+            entry['validated'] = time.time()
+            self._write_entry(url, entry)
+            return data
+
+        self.store(url, body, etag=etag, last_modified=last_modified)
+        return body
+
+    def evict(self):
+        """Remove least recently used blobs until the cache is back under 90% of max_size"""
+        blobs_dir = os.path.join(self.directory, 'blobs')
+        with open(os.path.join(self.directory, '.evict.lock'), 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            blobs = []
+            for root, _, file_names in os.walk(blobs_dir):
+                for file_name in file_names:
+                    if file_name.endswith('.tmp'):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, file_name))
+                    except OSError:
+                        continue
+                    blobs.append((stat.st_mtime, stat.st_size, os.path.join(root, file_name)))
+
+            total_size = sum(size for _, size, _ in blobs)
+            if total_size <= self.max_size:
+                return
+
+            target_size = self.max_size * 0.9
+            num_evicted = 0
+            for _, size, path in sorted(blobs):
+                if total_size <= target_size:
+                    break
+                try:
+                    os.remove(path)
+                    total_size -= size
+                    num_evicted += 1
+                except OSError:
+                    pass
+
+            logger.info("Evicted %d images from the image cache %s" % (num_evicted, self.directory))
+
+
+_default_image_cache = None
+_default_image_cache_lock = threading.Lock()
+
+
+def default_image_cache():
+    global _default_image_cache
+    with _default_image_cache_lock:
+        if _default_image_cache is None:
+            _default_image_cache = ImageCache()
+        return _default_image_cache
+
+
+def fetch_image_bytes(url, s3_client=None, cache=None):
+    """
+    Fetch an image from S3 or over HTTP(S) through the shared on-disk image cache
+
+    :param cache: ImageCache, defaults to the cache under data_dir(), pass False to bypass caching
+    """
+    if cache is False:
+        return default_image_fetcher().fetch(url, s3_client=s3_client)[0]
+
+    return (cache or default_image_cache()).fetch(url, s3_client=s3_client)
@@ -0,0 +1,228 @@
+from concurrent.futures import ProcessPoolExecutor
+import queue
+import threading
+import time
+
+from .log import logger
+
+# Sentinel passed down a stage's input queue once everything upstream is done
+_END = object()
+
+
+class Stage(object):
+    """
+    A pipeline step applying function to every item it receives, on a pool of threads or processes.
+
+    With fan_out, function returns an iterable and each of its values is passed on separately (process stages
+    must return a list), returning an empty list drops the item. Items aren't kept in order, stages that need
+    order carry their own index in the items.
+    """
+
+    def __init__(self, name, function, workers=1, processes=False, fan_out=False, queue_size=None):
+        """
+        :param function: function(item), run in a separate process when processes is set so it must be picklable
+        :param workers: number of threads (or processes) running function concurrently
+        :param queue_size: bound of the stage's input queue, defaults to twice workers. A full queue blocks the
+                           stage feeding it, applying backpressure all the way back to the pipeline's input
+        """
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.processes = processes
+        self.fan_out = fan_out
+        self.queue_size = max(1, queue_size or self.workers * 2)
+
+
+class StageStats(object):
+    def __init__(self, stage):
+        self.name = stage.name
+        self.workers = stage.workers
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.queue_depth_total = 0
+        self.queue_depth_samples = 0
+        self.queue_depth_max = 0
+        self._lock = threading.Lock()
+
+    def sample_queue_depth(self, depth):
+        with self._lock:
+            self.queue_depth_total += depth
+            self.queue_depth_samples += 1
+            self.queue_depth_max = max(self.queue_depth_max, depth)
+
+    def record(self, items_in, items_out, busy_seconds):
+        with self._lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.busy_seconds += busy_seconds
+
+    def as_dict(self, elapsed):
+        """
+        :return: dict of the stage's counts, throughput (input items per second of pipeline run time),
+                 utilization (fraction of its workers' time spent in function) and input queue depth
+        """
+        with self._lock:
+            return {
+                'name': self.name,
+                'workers': self.workers,
+                'items_in': self.items_in,
+                'items_out': self.items_out,
+                'throughput': self.items_in / elapsed if elapsed > 0 else 0.0,
+                'utilization': self.busy_seconds / (elapsed * self.workers) if elapsed > 0 else 0.0,
+                'queue_depth_avg': self.queue_depth_total / max(1, self.queue_depth_samples),
+                'queue_depth_max': self.queue_depth_max
+            }
+
+
+class Pipeline(object):
+    """
+    Runs items through a chain of stages connected by bounded queues. Every stage works concurrently with the
+    others, so throughput is set by the slowest stage rather than the sum of all of them, and the bounded queues
+    cap how many items are in flight. The first error raised by a stage stops the pipeline and is re-raised.
+    """
+
+    def __init__(self, stages, poll_interval=0.1):
+        self.stages = stages
+        self.poll_interval = poll_interval
+        self.elapsed = 0.0
+        self._stats = [StageStats(stage) for stage in stages]
+        self._remaining_lock = threading.Lock()
+
+    def _put(self, q, item, abort):
+        while not abort.is_set():
+            try:
+                q.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _get(self, q, abort):
+        while not abort.is_set():
+            try:
+                return q.get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
+
+        return _END
+
+    def _feed(self, items, outbox, abort, errors):
+        try:
+            for item in items:
+                if not self._put(outbox, item, abort):
+                    return
+        except Exception as e:
+            errors.append(e)
+            abort.set()
+            return
+
+        self._put(outbox, _END, abort)
+
+    def _work(self, idx, executor, inbox, outbox, remaining, abort, errors):
+        stage = self.stages[idx]
+        stats = self._stats[idx]
+        while True:
+            item = self._get(inbox, abort)
+            if item is _END:
+                # Let the stage's other workers see the end too, the last one out passes it downstream
+                self._put(inbox, _END, abort)
+                with self._remaining_lock:
+                    remaining[idx] -= 1
+                    last = remaining[idx] == 0
+                if last:
+                    self._put(outbox, _END, abort)
+                return
+
+            stats.sample_queue_depth(inbox.qsize())
+            try:
+                start = time.time()
+                if executor is not None:
+                    result = executor.submit(stage.function, item).result()
+                else:
+                    result = stage.function(item)
+                busy_seconds = time.time() - start
+
+                results = iter(result if stage.fan_out else [result])
+                num_results = 0
+                while True:
+                    # Fanned out values are passed on as they're produced, only time spent producing them counts
+                    start = time.time()
+                    value = next(results, _END)
+                    busy_seconds += time.time() - start
+                    if value is _END:
+                        break
+
+                    num_results += 1
+                    if not self._put(outbox, value, abort):
+                        return
+            except Exception as e:
+                logger.error("Pipeline stage '%s' failed: %s" % (stage.name, e))
+                errors.append(e)
+                abort.set()
+                return
+
+            stats.record(1, num_results, busy_seconds)
+
+    def run(self, items):
+        """
+        :param items: iterable of input items, consumed on a separate thread as the first stage has room
+        :return: generator of the last stage's results
+        """
+        # Fork worker processes before any of the pipeline's threads exist
+        executors = {}
+        for idx, stage in enumerate(self.stages):
+            if stage.processes:
+                executors[idx] = ProcessPoolExecutor(max_workers=stage.workers)
+                executors[idx].submit(int).result()
+
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        queues.append(queue.Queue(maxsize=self.stages[-1].queue_size))
+        abort = threading.Event()
+        errors = []
+        # Workers of each stage still running
+        remaining = [stage.workers for stage in self.stages]
+
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], abort, errors), daemon=True)]
+        for idx, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(idx, executors.get(idx), queues[idx], queues[idx + 1], remaining, abort, errors),
+                    daemon=True))
+
+        start = time.time()
+        try:
+            for thread in threads:
+                thread.start()
+
+            while True:
+                item = self._get(queues[-1], abort)
+                if item is _END:
+                    break
+                yield item
+        finally:
+            # Stops the stages early when the consumer stops iterating or a stage failed
+            abort.set()
+            for thread in threads:
+                thread.join()
+            for executor in executors.values():
+                executor.shutdown()
+            self.elapsed = time.time() - start
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def stats(self):
+        """
+        :return: list of StageStats.as_dict dicts, in stage order
+        """
+        return [stats.as_dict(self.elapsed) for stats in self._stats]
+
+    def log_stats(self):
+        for stats in self.stats():
+            logger.info("Stage '%s' (%d workers): %d in, %d out, %.1f items/s, %.0f%% busy, queue depth avg %.1f "
+                        "max %d" % (stats['name'], stats['workers'], stats['items_in'], stats['items_out'],
+                                    stats['throughput'], stats['utilization'] * 100, stats['queue_depth_avg'],
+                                    stats['queue_depth_max']))
@@ -1,8 +1,8 @@
 import abc
 
-import boto3
 from botocore.exceptions import ClientError
 
+from ..aws.client import get_client
 from ..aws.s3_util import list_object_keys_in_folder
 
 
@@ -19,9 +19,12 @@ class PlatformInterface(metaclass=abc.ABCMeta):
 
     @staticmethod
     def list_images_in_s3_folder(s3_images_uri):
+        """
+        :return: generator of image keys, streamed as the folder is listed
+        """
         try:
-            s3_client = boto3.client('s3')
-            return list_object_keys_in_folder(s3_client, s3_images_uri, image_filter=True)
+            s3_client = get_client('s3')
+            yield from list_object_keys_in_folder(s3_client, s3_images_uri, image_filter=True)
         except ClientError as e:
             print("Unexpected error loading folder contents from '%s': %s" % (s3_images_uri, e))
             raise e
@@ -20,6 +20,7 @@ from .models.job import JobList, Job
 from .utils.bounding_box import non_max_suppression_fast
 from .utils.util import random_id
 from ..coco.models.annotation import KeypointAnnotation as CocoKeypointAnnotation
+from ..coco.columnar import is_coco_npz, iter_coco_arrays, load_coco_npz
 from ..coco.models.category import all_coco_categories
 from ..log import logger
 from ..aws.s3_util import split_s3_bucket_key
@@ -251,7 +252,15 @@ class Labelbox(PlatformInterface):
         project = LabelboxAPI.fetch_raw_project_by_name(job_name)
         ontology = LabelboxAPI.get_project_ontology(project.uid)
 
-        coco = COCO(coco_annotation_file)
+        if is_coco_npz(coco_annotation_file):
+            # pycocotools indexes plain dicts, build them straight from the columnar arrays
+            coco = COCO()
+            coco.dataset = {'images': [], 'annotations': [], 'categories': []}
+            for section, record in iter_coco_arrays(load_coco_npz(coco_annotation_file)):
+                coco.dataset[section].append(record.dict())
+            coco.createIndex()
+        else:
+            coco = COCO(coco_annotation_file)
         cat_ids = coco.getCatIds(catNms=list(map(lambda x: x.name.lower(), all_coco_categories())))
         img_ids = coco.getImgIds(catIds=cat_ids)
         for img_id in img_ids:
@@ -330,10 +339,17 @@ class Labelbox(PlatformInterface):
 
     def generate_mal_ndjson(self, job_name, coco_model, filter_dataset_id=None):
         """Annotations object format: [{'image': Coco.Image, 'annotations': Coco.Annotation}]"""
+        return list(self.iter_mal_ndjson(job_name, coco_model, filter_dataset_id=filter_dataset_id))
+
+    def iter_mal_ndjson(self, job_name, coco_model, filter_dataset_id=None):
+        """
+        Generate MAL ndjson records one at a time, so they can be written out as they're produced
+
+        :return: generator of MAL record dicts
+        """
         project = LabelboxAPI.fetch_raw_project_by_name(job_name)
         ontology = LabelboxAPI.get_project_ontology(project.uid)
 
-        mal_records = []
         max_retries = 3
 
         retry = 0
@@ -392,7 +408,7 @@ class Labelbox(PlatformInterface):
                 logger.info("Adding labels for annotation id: %s" % coco_annotation.id)
                 labels = coco_annotation_to_labelbox(coco_annotation, ontology)
                 for label in labels:
-                    mal_records.append({
+                    yield {
                         **{
                             "uuid": str(uuid.uuid5(MAL_NAMESPACE, "%s_%s_%s" % (label['schema_id'], data_row.uid, json.dumps(label['labelbox_geom'])))),
                             "schemaId": label['schema_id'],
@@ -401,9 +417,7 @@ class Labelbox(PlatformInterface):
                             },
                         },
                         **label['labelbox_geom']
-                    })
-
-        return mal_records
+                    }
 
     def create_mal_import_job(self, job_name, mal_file_url, deleteFeatures):
         project = LabelboxAPI.fetch_raw_project_by_name(job_name)
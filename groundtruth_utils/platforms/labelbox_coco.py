@@ -2,7 +2,7 @@ from enum import Enum, IntEnum
 import re
 
 from ..coco.models.annotation import KeypointAnnotation
-from ..coco.models.category import KeypointCategory, get_coco_category_by_id
+from ..coco.models.category import KEYPOINT_LABELS, KeypointCategory, get_coco_category_by_id
 from .labelbox_utils import labelbox_geom_to_geojson
 
 
@@ -29,42 +29,7 @@ def coco_visibility_to_labelbox(coco_visibility: KeypointAnnotation.Visibility):
 
 
 def coco_category_to_labelbox(coco_category: KeypointCategory.Keypoint):
-    if coco_category == KeypointCategory.Keypoint.NOSE:
-        return 'Nose'
-    elif coco_category == KeypointCategory.Keypoint.NECK:
-        return 'Neck'
-    elif coco_category == KeypointCategory.Keypoint.LEFT_EYE:
-        return 'Left Eye'
-    elif coco_category == KeypointCategory.Keypoint.RIGHT_EYE:
-        return 'Right Eye'
-    elif coco_category == KeypointCategory.Keypoint.LEFT_EAR:
-        return 'Left Ear'
-    elif coco_category == KeypointCategory.Keypoint.RIGHT_EAR:
-        return 'Right Ear'
-    elif coco_category == KeypointCategory.Keypoint.LEFT_SHOULDER:
-        return 'Left Shoulder'
-    elif coco_category == KeypointCategory.Keypoint.RIGHT_SHOULDER:
-        return 'Right Shoulder'
-    elif coco_category == KeypointCategory.Keypoint.LEFT_ELBOW:
-        return 'Left Elbow'
-    elif coco_category == KeypointCategory.Keypoint.RIGHT_ELBOW:
-        return 'Right Elbow'
-    elif coco_category == KeypointCategory.Keypoint.LEFT_WRIST:
-        return 'Left Wrist'
-    elif coco_category == KeypointCategory.Keypoint.RIGHT_WRIST:
-        return 'Right Wrist'
-    elif coco_category == KeypointCategory.Keypoint.LEFT_HIP:
-        return 'Left Hip'
-    elif coco_category == KeypointCategory.Keypoint.RIGHT_HIP:
-        return 'Right Hip'
-    elif coco_category == KeypointCategory.Keypoint.LEFT_KNEE:
-        return 'Left Knee'
-    elif coco_category == KeypointCategory.Keypoint.RIGHT_KNEE:
-        return 'Right Knee'
-    elif coco_category == KeypointCategory.Keypoint.LEFT_ANKLE:
-        return 'Left Ankle'
-    elif coco_category == KeypointCategory.Keypoint.RIGHT_ANKLE:
-        return 'Right Ankle'
+    return KEYPOINT_LABELS.get(coco_category)
 
 
 def coco_keypoint_to_labelbox_string(coco_category: KeypointCategory.Keypoint,
@@ -1,21 +1,27 @@
 import io
 import os
 
-import boto3
 from botocore.exceptions import ClientError
 import json
 
 from .interface import PlatformInterface
-from .models.image import ImageList
+from .models.image import Image, ImageList
 from .models.job import Job, JobList
-from ..aws.s3_util import download_fileobj_as_bytestream, split_s3_bucket_key
+from ..aws.client import get_client
+from ..aws.s3_util import iter_object_lines, split_s3_bucket_key
+
+# Concurrent ranged reads of output manifests larger than iter_object_lines' range size, 1 streams them in one GET
+SAGEMAKER_MANIFEST_READ_WORKERS = int(os.getenv('WF_GROUNDTRUTH_SAGEMAKER_MANIFEST_READ_WORKERS', 1))
 
 
 class Sagemaker(PlatformInterface):
+    def __init__(self, manifest_read_workers=SAGEMAKER_MANIFEST_READ_WORKERS):
+        self.manifest_read_workers = max(1, manifest_read_workers)
+
     @staticmethod
     def fetch_job_by_name(job_name: str):
         try:
-            sm_client = boto3.client('sagemaker')
+            sm_client = get_client('sagemaker')
             job_raw = sm_client.describe_labeling_job(
                 LabelingJobName=job_name
             )
@@ -34,7 +40,7 @@ class Sagemaker(PlatformInterface):
             raise Exception("'status' must be one of %s" % valid_options)
 
         try:
-            client = boto3.client('sagemaker')
+            client = get_client('sagemaker')
             paginator = client.get_paginator('list_labeling_jobs')
             page_iterator = paginator.paginate(
                 StatusEquals=status_title,
@@ -58,28 +64,32 @@ class Sagemaker(PlatformInterface):
             raise e
 
     def fetch_annotations(self, job_name: str, consolidate=True, filter_min_confidence=0.0, filter_min_labelers=3):
+        return ImageList(images=list(self.iter_annotations(job_name))), None
+
+    def iter_annotations(self, job_name: str, max_workers=None):
+        """
+        Stream the job's output manifest, deserializing images line by line as it downloads
+
+        :param max_workers: number of concurrent ranged reads for very large manifests, defaults to the
+                            platform's manifest_read_workers
+        :return: generator of Image
+        """
+        if max_workers is None:
+            max_workers = self.manifest_read_workers
+
         job_raw = self.__class__.fetch_job_by_name(job_name)
 
         output_annotations_uri = job_raw['LabelingJobOutput']['OutputDatasetS3Uri']
 
         try:
-            s3_client = boto3.client('s3')
-            bytes_stream = download_fileobj_as_bytestream(s3_client, output_annotations_uri)
+            s3_client = get_client('s3')
+            for line in iter_object_lines(s3_client, output_annotations_uri, max_workers=max_workers):
+                if len(line.strip()) > 0:
+                    yield Image.deserialize_sagemaker(json.loads(line))
         except ClientError as e:
             print("Unexpected error fetching %s: %s" % (output_annotations_uri, e))
             raise e
 
-        try:
-            bytes_stream.seek(0)
-            annotations_json = [json.loads(line) for line in bytes_stream.readlines()]
-        finally:
-            bytes_stream.close()
-
-        if annotations_json is None:
-            raise Exception("unable to download/process annotations data")
-
-        return ImageList.deserialize_sagemaker(annotations_json), None
-
     def generate_manifest(self, s3_images_uri: str, metadata: dict):
         folder_object_uris = self.__class__.list_images_in_s3_folder(s3_images_uri)
 
@@ -97,7 +107,7 @@ class Sagemaker(PlatformInterface):
                     "source-ref": "https://{0}.s3.amazonaws.com/{1}".format(bucket, object_key),
                     "metadata": custom_metadata
                 }) + "\n")
-                output = fp.getvalue()
+            output = fp.getvalue()
         finally:
             fp.close()
 
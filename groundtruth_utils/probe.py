@@ -0,0 +1,145 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import os
+import tempfile
+import threading
+
+from PIL import Image
+
+from .base import data_dir
+from .fetcher import default_image_fetcher
+from .image_cache import cache_key_url, default_image_cache
+from .log import logger
+
+# Header sizes tried in turn, most PNG/WebP/GIF headers fit in the first, JPEGs with large EXIF blocks need more
+PROBE_RANGES = [64 * 1024, 512 * 1024, 4 * 1024 * 1024]
+
+
+def image_dimensions_cache_path():
+    return os.path.join(data_dir(), 'image_dimensions.json')
+
+
+class ImageDimensionsCache(object):
+    """
+    Persistent url -> [width, height] cache stored under data_dir(). Presigned URL parameters are dropped
+    from keys. Saves merge with the file on disk and replace it atomically
+    so concurrent runs don't clobber each other.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or image_dimensions_cache_path()
+        self._lock = threading.Lock()
+        self._dimensions = self._read()
+        self._dirty = False
+
+    @staticmethod
+    def key(url):
+        return cache_key_url(url)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, url):
+        with self._lock:
+            return self._dimensions.get(self.__class__.key(url))
+
+    def set(self, url, dimensions):
+        with self._lock:
+            self._dimensions[self.__class__.key(url)] = list(dimensions)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+
+            merged = self._read()
+            merged.update(self._dimensions)
+
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(merged, f)
+            os.replace(temp_path, self.path)
+
+            self._dimensions = merged
+            self._dirty = False
+
+
+def fetch_image_header(url, num_bytes, s3_client=None):
+    """Fetch the first num_bytes of an image with a ranged GET"""
+    return default_image_fetcher().fetch(url, byte_range=(0, num_bytes - 1), s3_client=s3_client)[0][:num_bytes]
+
+
+def probe_image_dimensions(url, s3_client=None):
+    """
+    Read an image's dimensions from its header bytes, without downloading the whole image
+
+    :return: Tuple of (width, height) or None if the image couldn't be probed
+    """
+    cached_path = default_image_cache().cached_path(url)
+    if cached_path is not None:
+        try:
+            with Image.open(cached_path) as img:
+                return img.size
+        except Exception:
+            pass
+
+    for num_bytes in PROBE_RANGES:
+        header = fetch_image_header(url, num_bytes, s3_client=s3_client)
+        try:
+            with Image.open(io.BytesIO(header)) as img:
+                return img.size
+        except Exception:
+            # Header didn't fit in the range, unless we already have the whole file
+            if len(header) < num_bytes:
+                break
+
+    return None
+
+
+def probe_images_dimensions(urls, max_workers=16, cache=None):
+    """
+    Probe the dimensions of many images concurrently, results are read from and added to the cache
+
+    :param cache: ImageDimensionsCache, defaults to the cache under data_dir(), pass False to disable caching
+    :return: dict of url -> (width, height), images that failed to probe are left out
+    """
+    if cache is None:
+        cache = ImageDimensionsCache()
+
+    dimensions = {}
+    pending_urls = []
+    for url in dict.fromkeys(urls):
+        cached = cache.get(url) if cache else None
+        if cached is not None:
+            dimensions[url] = tuple(cached)
+        else:
+            pending_urls.append(url)
+
+    logger.info("Probing dimensions for %d images (%d cached)" % (len(pending_urls), len(dimensions)))
+
+    def probe(url):
+        try:
+            return url, probe_image_dimensions(url)
+        except Exception as e:
+            logger.warning("Failed probing dimensions for %s: %s" % (url, e))
+            return url, None
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for url, size in executor.map(probe, pending_urls):
+            if size is None:
+                continue
+
+            dimensions[url] = tuple(size)
+            if cache:
+                cache.set(url, size)
+
+    if cache:
+        cache.save()
+
+    return dimensions
@@ -0,0 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from botocore.config import Config
+
+from groundtruth_utils.aws import client
+
+
+def test_get_client_shares_one_client_across_threads():
+    config = Config(read_timeout=5)
+    with mock.patch.object(client, '_clients', {}), mock.patch.object(client, '_session', None), \
+            mock.patch.object(client.boto3.session, 'Session') as session:
+        session.return_value.client.side_effect = lambda *args, **kwargs: object()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(lambda _: client.get_client('s3', config=config), range(32)))
+
+        assert len(set(map(id, clients))) == 1
+        assert session.call_count == 1
+        assert client.get_client('s3') is not clients[0]
+
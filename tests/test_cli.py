@@ -0,0 +1,27 @@
+from unittest import mock
+
+from click.testing import CliRunner
+
+from groundtruth_utils.cli import cli
+
+
+def test_generate_image_set_mosaic_mode():
+    with mock.patch('groundtruth_utils.cli.generate_image_set') as generate_image_set:
+        result = CliRunner().invoke(cli, ['generate-image-set', '-m', 'mosaic', '--mosaic-grid', '4x3',
+                                          '--mosaic-tile-size', '160x100', 'job'])
+
+    assert result.exit_code == 0, result.output
+    generate_image_set.assert_called_once()
+    args, kwargs = generate_image_set.call_args
+    assert args == ('job',)
+    assert kwargs['mode'] == 'mosaic'
+    assert kwargs['mosaic_grid'] == (4, 3)
+    assert kwargs['mosaic_tile_size'] == (160, 100)
+
+
+def test_generate_image_set_rejects_unknown_mode():
+    with mock.patch('groundtruth_utils.cli.generate_image_set') as generate_image_set:
+        result = CliRunner().invoke(cli, ['generate-image-set', '-m', 'collage', 'job'])
+
+    assert result.exit_code == 2
+    generate_image_set.assert_not_called()
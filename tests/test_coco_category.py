@@ -0,0 +1,26 @@
+import pytest
+
+from groundtruth_utils.coco.models.category import all_coco_categories, get_coco_category, get_coco_category_by_id
+
+
+def test_shared_categories_are_immutable():
+    category = get_coco_category('Person')
+    assert category is get_coco_category_by_id(category.id)
+
+    with pytest.raises(TypeError):
+        category.name = 'someone'
+    with pytest.raises(AttributeError):
+        category.keypoints.append('tail')
+
+    assert get_coco_category('person').name == 'person'
+    assert len(get_coco_category('person').keypoints) == 17
+
+
+def test_all_coco_categories_returns_mutable_copies():
+    categories = all_coco_categories()
+    categories[0].name = 'someone'
+    categories[0].keypoints.append('tail')
+
+    category = all_coco_categories()[0]
+    assert category.name == 'person'
+    assert category.keypoints == list(get_coco_category('person').keypoints)
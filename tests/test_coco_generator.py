@@ -0,0 +1,38 @@
+from groundtruth_utils.coco.manifest import CocoManifest
+from groundtruth_utils.coco_generator import CocoGenerator
+from groundtruth_utils.coco_plan import CocoJobPlan
+from groundtruth_utils.platforms.models.annotation import AnnotationTypes, BoundingBoxAnnotation
+from groundtruth_utils.platforms.models.image import Image, ImageList
+
+JOB_PLAN = CocoJobPlan({
+    'name': 'job',
+    'annotations': [{'type': 'bbox', 'category': 'person', 'match': '$[?(@.label == "person")]'}]
+})
+
+
+def job_images(url, left=10.0):
+    annotation = BoundingBoxAnnotation(id='box', type=AnnotationTypes.TYPE_BOUNDING_BOX, label='person',
+                                       left=left, top=20.0, width=30.0, height=40.0, raw_annotation={})
+    image = Image(id='data-row', external_id='classroom/camera-01.jpg', url=url, annotations=[annotation])
+    image.set_excluded_null()
+    return [(JOB_PLAN, (ImageList(images=[image]), ImageList(images=[])))]
+
+
+def test_input_hash_ignores_url_signing_params(tmp_path):
+    first_export = job_images('https://bucket.s3.amazonaws.com/camera-01.jpg?X-Amz-Signature=first&X-Amz-Expires=60')
+    second_export = job_images('https://bucket.s3.amazonaws.com/camera-01.jpg?X-Amz-Signature=second&X-Amz-Expires=90')
+
+    manifest = CocoManifest(str(tmp_path / 'manifest.json'))
+    for external_id, input_hash in CocoGenerator._image_input_hashes(first_export).items():
+        manifest.set(external_id, input_hash, [])
+    manifest.save([])
+
+    manifest = CocoManifest(str(tmp_path / 'manifest.json'))
+    input_hashes = CocoGenerator._image_input_hashes(second_export)
+    assert all(manifest.is_unchanged(external_id, input_hash) for external_id, input_hash in input_hashes.items())
+
+
+def test_input_hash_changes_with_annotations_and_url():
+    input_hash = CocoGenerator._image_input_hashes(job_images('https://host/camera-01.jpg'))
+    assert CocoGenerator._image_input_hashes(job_images('https://host/camera-01.jpg', left=11.0)) != input_hash
+    assert CocoGenerator._image_input_hashes(job_images('https://host/camera-02.jpg')) != input_hash
@@ -0,0 +1,58 @@
+from groundtruth_utils.coco.models.annotation import KeypointAnnotation
+from groundtruth_utils.coco.models.coco import Coco
+from groundtruth_utils.coco.models.image import Image
+
+
+def annotation(annotation_id, image_id):
+    return KeypointAnnotation(id=annotation_id, image_id=image_id, category_id=1)
+
+
+def annotation_ids(annotations):
+    return sorted(a.id for a in annotations)
+
+
+def test_index_catches_up_on_appends():
+    coco = Coco(annotations=[annotation(1, 10)])
+    assert annotation_ids(coco.get_annotations_for_image(10)) == [1]
+
+    coco.annotations.append(annotation(2, 10))
+    coco.annotations.extend([annotation(3, 11)])
+    assert annotation_ids(coco.get_annotations_for_image(10)) == [1, 2]
+    assert annotation_ids(coco.get_annotations_for_image(11)) == [3]
+
+
+def test_index_rebuilds_after_other_mutations():
+    coco = Coco(annotations=[annotation(1, 10), annotation(2, 11)])
+    assert annotation_ids(coco.get_annotations_for_image(11)) == [2]
+
+    coco.annotations.pop(0)
+    coco.annotations.append(annotation(3, 11))
+    assert annotation_ids(coco.get_annotations_for_image(11)) == [2, 3]
+    assert coco.get_annotations_for_image(10) == []
+
+    coco.annotations[0] = annotation(4, 10)
+    assert annotation_ids(coco.get_annotations_for_image(10)) == [4]
+    assert annotation_ids(coco.get_annotations_for_image(11)) == [3]
+
+
+def test_index_follows_replaced_lists():
+    coco = Coco(images=[Image(id=1, file_name='a.jpg', coco_url='a.jpg', width=1, height=1)])
+    assert coco.get_image_by_file_name('a.jpg').id == 1
+
+    coco.images = [Image(id=2, file_name='b.jpg', coco_url='b.jpg', width=1, height=1)]
+    assert coco.get_image_by_file_name('a.jpg') is None
+
+    coco.images.insert(0, Image(id=3, file_name='a.jpg', coco_url='a.jpg', width=1, height=1))
+    assert coco.get_image_by_file_name('a.jpg').id == 3
+
+
+def test_split_keeps_annotations_with_their_images():
+    images = [Image(id=i, file_name="%d.jpg" % i, coco_url="%d.jpg" % i, width=1, height=1) for i in range(10)]
+    coco = Coco(images=images, annotations=[annotation(i, i % 10) for i in range(30)])
+
+    coco_front, coco_back = coco.split(0.3, seed=1)
+    assert len(coco_front.images) == 3
+    for split_coco in [coco_front, coco_back]:
+        for image in split_coco.images:
+            assert annotation_ids(split_coco.get_annotations_for_image(image.id)) == [image.id, image.id + 10,
+                                                                                      image.id + 20]
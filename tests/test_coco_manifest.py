@@ -0,0 +1,71 @@
+import os
+
+from groundtruth_utils.coco.manifest import CocoManifest, image_input_hash
+from groundtruth_utils.coco.models.annotation import KeypointAnnotation
+from groundtruth_utils.coco.models.image import Image
+from groundtruth_utils.coco.writer import CocoJsonWriter
+
+CONTRIBUTIONS = [('job-fingerprint', False, '{"external_id": "classroom/camera-01.jpg"}')]
+
+
+def test_image_input_hash_depends_on_probe_dimensions():
+    assert image_input_hash(CONTRIBUTIONS) == image_input_hash(CONTRIBUTIONS, probe_dimensions=False)
+    assert image_input_hash(CONTRIBUTIONS, probe_dimensions=True) != image_input_hash(CONTRIBUTIONS)
+
+
+def test_image_input_hash_depends_on_mode_and_inputs():
+    assert image_input_hash(CONTRIBUTIONS, separate_by_annotation=True) != image_input_hash(CONTRIBUTIONS)
+    assert image_input_hash([('job-fingerprint', True, CONTRIBUTIONS[0][2])]) != image_input_hash(CONTRIBUTIONS)
+
+
+def save_run(tmp_path, output_name='coco.json.gz'):
+    manifest = CocoManifest(str(tmp_path / 'manifest.json.gz'))
+    output = str(tmp_path / output_name)
+    with CocoJsonWriter(output) as writer:
+        for external_id in ['camera-01.jpg', 'camera-02.jpg']:
+            image = Image(id=manifest.image_id(external_id), file_name=external_id,
+                          coco_url="s3://bucket/%s" % external_id, width=640, height=480)
+            annotation = KeypointAnnotation(id=manifest.annotation_id(external_id, external_id), image_id=image.id,
+                                            category_id=1, bbox=[1.0, 2.0, 3.0, 4.0])
+            writer.write_image(image)
+            writer.write_annotation(annotation)
+            manifest.set(external_id, "hash-%s" % external_id, [(image, [(external_id, annotation)])])
+    manifest.save([output])
+    return output
+
+
+def test_manifest_rebuilds_unchanged_records_from_previous_output(tmp_path):
+    output = save_run(tmp_path)
+
+    manifest = CocoManifest(str(tmp_path / 'manifest.json.gz'))
+    assert manifest.is_unchanged('camera-01.jpg', 'hash-camera-01.jpg')
+    assert not manifest.is_unchanged('camera-02.jpg', 'changed')
+
+    records = manifest.previous_records(['camera-02.jpg'])
+    assert list(records.keys()) == ['camera-02.jpg']
+    [(image, annotations)] = records['camera-02.jpg']
+    assert (image.id, image.file_name, image.width) == (2, 'camera-02.jpg', 640)
+    assert [(annotation.id, annotation.image_id, annotation.bbox) for annotation in annotations] == \
+        [(1, 2, [1.0, 2.0, 3.0, 4.0])]
+    assert manifest.image_id('camera-03.jpg') == 3
+
+    assert oct(os.stat(str(tmp_path / 'manifest.json.gz')).st_mode & 0o777) == \
+        oct(os.stat(output).st_mode & 0o777)
+
+
+def test_manifest_regenerates_images_when_previous_output_is_missing(tmp_path):
+    os.remove(save_run(tmp_path))
+
+    manifest = CocoManifest(str(tmp_path / 'manifest.json.gz'))
+    assert not manifest.is_unchanged('camera-01.jpg', 'hash-camera-01.jpg')
+    assert manifest.image_id('camera-01.jpg') == 1
+
+
+def test_manifest_skips_images_missing_from_previous_output(tmp_path):
+    output = save_run(tmp_path)
+    with CocoJsonWriter(output) as writer:
+        writer.write_image(Image(id=1, file_name='camera-01.jpg', coco_url="s3://bucket/camera-01.jpg",
+                                 width=640, height=480))
+
+    manifest = CocoManifest(str(tmp_path / 'manifest.json.gz'))
+    assert manifest.previous_records(['camera-01.jpg', 'camera-02.jpg']) == {}
@@ -0,0 +1,106 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from groundtruth_utils.coco import writer as writer_module
+from groundtruth_utils.coco.models.image import Image
+from groundtruth_utils.coco.writer import CocoJsonWriter, CocoShardWriter, CocoSplitWriter, open_coco_file
+
+
+def coco_image(image_id):
+    return Image(id=image_id, file_name="image-%d.jpg" % image_id, coco_url="s3://bucket/image-%d.jpg" % image_id,
+                 width=640, height=480)
+
+
+def test_json_writer_writes_on_success(tmp_path):
+    file_path = str(tmp_path / 'coco.json.gz')
+    with CocoJsonWriter(file_path) as writer:
+        writer.write_image(coco_image(1))
+
+    with open_coco_file(file_path) as f:
+        assert json.load(f) == {'images': [coco_image(1).dict()], 'annotations': [], 'categories': []}
+    assert os.listdir(str(tmp_path)) == ['coco.json.gz']
+
+
+def test_writers_leave_nothing_behind_on_error(tmp_path):
+    with pytest.raises(RuntimeError):
+        with CocoJsonWriter(str(tmp_path / 'val.json')) as validation_writer, \
+                CocoShardWriter([CocoJsonWriter(str(tmp_path / ("train-%d.json" % idx))) for idx in range(3)]) \
+                as train_writer:
+            split_writer = CocoSplitWriter(validation_writer, train_writer, percent=0.5, seed=1)
+            split_writer.start(num_images=4)
+            for image_id in range(4):
+                split_writer.write_image(coco_image(image_id))
+            raise RuntimeError("platform fetch failed")
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_shard_writer_only_creates_outputs_when_closed(tmp_path):
+    shard_writer = CocoShardWriter([CocoJsonWriter(str(tmp_path / ("coco-%d.json" % idx))) for idx in range(4)])
+    with shard_writer:
+        shard_writer.start(num_images=8)
+        for image_id in range(8):
+            shard_writer.write_image(coco_image(image_id))
+        assert os.listdir(str(tmp_path)) == []
+
+    assert sorted(os.listdir(str(tmp_path))) == ["coco-%d.json" % idx for idx in range(4)]
+    with open(str(tmp_path / 'coco-1.json')) as f:
+        assert [image['id'] for image in json.load(f)['images']] == [1, 5]
+
+
+def test_json_writer_output_permissions(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        with CocoJsonWriter(str(tmp_path / 'coco.json')) as writer:
+            writer.write_image(coco_image(1))
+        assert os.stat(str(tmp_path / 'coco.json')).st_mode & 0o777 == 0o644
+
+        os.chmod(str(tmp_path / 'coco.json'), 0o640)
+        with CocoJsonWriter(str(tmp_path / 'coco.json')) as writer:
+            writer.write_image(coco_image(2))
+        assert os.stat(str(tmp_path / 'coco.json')).st_mode & 0o777 == 0o640
+    finally:
+        os.umask(umask)
+
+
+
+def test_split_writer_writes_nothing_when_a_back_shard_fails_to_stage(tmp_path):
+    train_writer = CocoShardWriter([CocoJsonWriter(str(tmp_path / ("train-%d.json" % idx))) for idx in range(2)])
+    split_writer = CocoSplitWriter(CocoJsonWriter(str(tmp_path / 'val.json')), train_writer, percent=0.5, seed=1)
+    split_writer.start(num_images=4)
+    for image_id in range(4):
+        split_writer.write_image(coco_image(image_id))
+
+    # The validation file and the first shard are staged before the last shard fails
+    with mock.patch.object(train_writer.shard_writers[-1], 'stage', side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            split_writer.close()
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_split_writer_removes_front_output_when_back_commit_fails(tmp_path):
+    split_writer = CocoSplitWriter(CocoJsonWriter(str(tmp_path / 'val.json')),
+                                   CocoJsonWriter(str(tmp_path / 'train.json')), percent=0.5, seed=1)
+    split_writer.start(num_images=2)
+    for image_id in range(2):
+        split_writer.write_image(coco_image(image_id))
+
+    replace_coco_file = writer_module.replace_coco_file
+    calls = []
+
+    def fail_second_replace(temp_path, file_path):
+        calls.append(file_path)
+        if len(calls) == 2:
+            raise OSError("rename failed")
+        replace_coco_file(temp_path, file_path)
+
+    with mock.patch.object(writer_module, 'replace_coco_file', side_effect=fail_second_replace):
+        with pytest.raises(OSError):
+            split_writer.close()
+
+    assert calls == [str(tmp_path / 'val.json'), str(tmp_path / 'train.json')]
+    assert os.listdir(str(tmp_path)) == []
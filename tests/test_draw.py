@@ -0,0 +1,34 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+from groundtruth_utils.draw import KEYPOINT_COLOR, KEYPOINT_FILL_ALPHA, render_annotations
+
+
+def render_pil(image, boxes, points):
+    pil_image = Image.fromarray(image)
+    draw = ImageDraw.Draw(pil_image, 'RGBA')
+    for left, top, width, height in boxes:
+        draw.rectangle([(left, top), (left + width, top + height)], fill=(0, 166, 156, 50), outline=(255, 255, 255),
+                       width=3)
+    for x, y in points:
+        draw.ellipse([(x - 3, y - 3), (x + 3, y + 3)], fill=(65, 255, 126, 95), outline=(65, 255, 126))
+    return np.array(pil_image)
+
+
+def test_render_annotations_matches_pil():
+    image = np.random.default_rng(0).integers(0, 256, (80, 120, 3), dtype=np.uint8)
+    boxes = [[5, 5, 40, 30], [60, 10, 20, 50]]
+    points = [[10, 60], [100, 70], [118, 2]]
+
+    rendered = render_annotations(image, boxes=boxes, points=points)
+
+    assert np.array_equal(rendered, render_pil(image, boxes, points))
+    assert not np.array_equal(rendered, image)
+
+
+def test_render_annotations_blends_overlapping_keypoints_once():
+    image = np.zeros((20, 20, 3), dtype=np.uint8)
+
+    rendered = render_annotations(image, points=[[10, 10], [11, 10], [-30, -30]])
+
+    assert list(rendered[10, 10]) == [round(channel * KEYPOINT_FILL_ALPHA) for channel in KEYPOINT_COLOR]
@@ -0,0 +1,20 @@
+from groundtruth_utils.fetcher import ImageFetcher
+
+
+def test_read_body_reuses_buffer_for_smaller_body():
+    fetcher = ImageFetcher(chunk_size=4)
+
+    large_body = fetcher._read_body([b'abcd', b'efgh', b'ij'])
+    buffer = fetcher._local.buffer
+    small_body = fetcher._read_body([b'xyz'], content_length=3)
+
+    assert large_body == b'abcdefghij'
+    assert small_body == b'xyz'
+    assert fetcher._local.buffer is buffer
+    assert isinstance(small_body, bytes)
+
+
+def test_read_body_stops_at_limit():
+    fetcher = ImageFetcher(chunk_size=4)
+
+    assert fetcher._read_body([b'abcd', b'efgh', b'ijkl'], limit=6) == b'abcdef'
@@ -0,0 +1,45 @@
+from groundtruth_utils.image_cache import ImageCache, cache_key_url
+from groundtruth_utils.probe import ImageDimensionsCache
+
+
+class FakeFetcher(object):
+    def __init__(self, images):
+        self.images = images
+        self.num_fetches = 0
+
+    def fetch(self, url, etag=None, last_modified=None, byte_range=None, s3_client=None):
+        self.num_fetches += 1
+        return self.images[url], None, None
+
+
+def test_cache_key_url_drops_only_presigning_params():
+    assert cache_key_url('https://host/a.jpg') == 'https://host/a.jpg'
+    assert cache_key_url('https://b.s3.amazonaws.com/a.jpg?AWSAccessKeyId=AK&Signature=S%2F&Expires=1') == \
+        'https://b.s3.amazonaws.com/a.jpg'
+    assert cache_key_url('https://b.s3.amazonaws.com/a.jpg?X-Amz-Algorithm=A&X-Amz-Signature=S&versionId=3') == \
+        'https://b.s3.amazonaws.com/a.jpg?versionId=3'
+    assert cache_key_url('https://host/image?id=1') != cache_key_url('https://host/image?id=2')
+
+
+def test_image_cache_keeps_identifying_query_params(tmp_path):
+    fetcher = FakeFetcher({
+        'https://host/image?id=1': b'one',
+        'https://host/image?id=2': b'two',
+        'https://host/a.jpg?X-Amz-Signature=first': b'a',
+        'https://host/a.jpg?X-Amz-Signature=second': b'a'
+    })
+    cache = ImageCache(directory=str(tmp_path), fetcher=fetcher)
+
+    assert cache.fetch('https://host/image?id=1') == b'one'
+    assert cache.fetch('https://host/image?id=2') == b'two'
+    assert cache.fetch('https://host/a.jpg?X-Amz-Signature=first') == b'a'
+    assert cache.fetch('https://host/a.jpg?X-Amz-Signature=second') == b'a'
+    assert fetcher.num_fetches == 3
+
+
+def test_dimensions_cache_keeps_identifying_query_params(tmp_path):
+    cache = ImageDimensionsCache(path=str(tmp_path / 'image_dimensions.json'))
+    cache.set('https://host/image?id=1&Signature=abc', (640, 480))
+
+    assert cache.get('https://host/image?id=1&Signature=def') == [640, 480]
+    assert cache.get('https://host/image?id=2') is None
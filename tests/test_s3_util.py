@@ -0,0 +1,48 @@
+import io
+import json
+
+import pytest
+
+from groundtruth_utils.aws.s3_util import iter_object_lines
+
+LINES = [json.dumps({'source-ref': "s3://bucket/image-%d.jpg" % idx, 'pad': 'x' * (idx % 37)}) for idx in range(2000)]
+
+
+class FakeS3Client(object):
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Range is None:
+            return {'Body': io.BytesIO(self.data)}
+
+        start, end = (int(offset) for offset in Range[len('bytes='):].split('-'))
+        self.ranges.append((start, end))
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+
+@pytest.mark.parametrize('trailing_newline', [True, False])
+@pytest.mark.parametrize('read_args', [
+    {},
+    {'chunk_size': 7},
+    {'max_workers': 4, 'range_size': 1000},
+    {'max_workers': 3, 'range_size': 17},
+    {'max_workers': 4}
+])
+def test_iter_object_lines(read_args, trailing_newline):
+    data = '\n'.join(LINES).encode('utf-8') + (b'\n' if trailing_newline else b'')
+    lines = [line.decode('utf-8') for line in iter_object_lines(FakeS3Client(data), 's3://bucket/output.manifest',
+                                                                **read_args)]
+    assert lines == LINES
+
+
+def test_iter_object_lines_reads_large_objects_as_ranges():
+    data = '\n'.join(LINES).encode('utf-8')
+    s3_client = FakeS3Client(data)
+    list(iter_object_lines(s3_client, 's3://bucket/output.manifest', max_workers=4, range_size=10000))
+
+    assert s3_client.ranges == [(start, min(start + 10000, len(data)) - 1) for start in range(0, len(data), 10000)]
@@ -0,0 +1,21 @@
+from unittest import mock
+
+from groundtruth_utils.platforms import sagemaker
+from groundtruth_utils.platforms.sagemaker import Sagemaker
+
+JOB = {'LabelingJobOutput': {'OutputDatasetS3Uri': 's3://bucket/job/output.manifest'}}
+
+
+def fetch_annotations_max_workers(platform):
+    with mock.patch.object(Sagemaker, 'fetch_job_by_name', return_value=JOB), \
+            mock.patch.object(sagemaker, 'get_client'), \
+            mock.patch.object(sagemaker, 'iter_object_lines', return_value=iter([])) as iter_object_lines:
+        images, invalid_images = platform.fetch_annotations('job')
+
+    assert images.images == [] and invalid_images is None
+    return iter_object_lines.call_args[1]['max_workers']
+
+
+def test_fetch_annotations_uses_manifest_read_workers():
+    assert fetch_annotations_max_workers(Sagemaker()) == sagemaker.SAGEMAKER_MANIFEST_READ_WORKERS
+    assert fetch_annotations_max_workers(Sagemaker(manifest_read_workers=8)) == 8